@@ -7,15 +7,24 @@ __version__ = "0.1.3"
 import os
 import copy
 
-from .get import get_yearly_count
-from .io import write_results_to_file, load_results_from_file
+from .get import database_name, get_yearly_count
+from .fanout import compute_multi_source_citations, flatten_sources
+from .distributed import Coordinator, run_worker
+from .periods import aggregate_results, period_range
+from .io import write_results_to_file, load_results_from_file, \
+    results_to_dataframe, results_from_dataframe, results_to_arrow, \
+    results_from_arrow
+from .normalise import get_denominator_series
 from .plot import plot_yearly_count
+from .progressive import progressive_yearly_citations, ProgressiveFetch
+from .snapshot import append_snapshot
 
 
 def compute_yearly_citations(search_term, start_date, end_date, \
     comparison_terms="banana", database="pubmed", exact_phrase=True, \
     pubmed_field="text", pause=1.0, verbose=False, save_to_file=None, \
-    plot_to_file=None, figsize=(8.0,6.0), dpi=100.0):
+    plot_to_file=None, figsize=(8.0,6.0), dpi=100.0, local_index=None, \
+    append_to_store=None, granularity="year", cache_comparisons=True):
     
     # Wrap the search and comparison terms in a list.
     if type(search_term) not in [tuple, list]:
@@ -33,20 +42,42 @@ def compute_yearly_citations(search_term, start_date, end_date, \
     # Construct the beginning of the result dict, with clarifications on which
     # terms is the target, which are comparisons, and what the range is.
     result_dict = {"_target":search_term, "_comparison":comparison_terms, \
-        "_year_range":list(range(start_date, end_date+1))}
+        "_year_range":period_range(start_date, end_date, granularity)}
+    # Also record how the counts were fetched, so that they can be stored
+    # (and compared) with counts that were fetched in the same way.
+    result_dict["_query"] = {"database":database_name(database), \
+        "pubmed_field":pubmed_field, "exact_phrase":exact_phrase, \
+        "local_index":local_index}
 
     # Count and store the yearly hits for each term.
     for i, term in enumerate(search_term + comparison_terms):
+        # Comparison terms (and "_total", the number of all records) are
+        # shared between studies, so they come from a cache that only
+        # requests counts it doesn't have yet. Snapshots are stamped with the
+        # current time, so counts that go into a store are all fetched anew
+        # (which also refreshes the cache).
+        if cache_comparisons and term in comparison_terms:
+            num = get_denominator_series(term, start_date, end_date, \
+                database=database, exact_phrase=exact_phrase, \
+                pubmed_field=pubmed_field, granularity=granularity, \
+                pause=pause, verbose=verbose, local_index=local_index, \
+                refresh=append_to_store is not None)
         # Count the number of hits for this term.
-        num = get_yearly_count(term, start_date, end_date, \
-            exact_phrase=exact_phrase, pubmed_field=pubmed_field, \
-            pause=pause, verbose=verbose)
+        else:
+            num = get_yearly_count(term, start_date, end_date, \
+                database=database, exact_phrase=exact_phrase, \
+                pubmed_field=pubmed_field, pause=pause, verbose=verbose, \
+                local_index=local_index, granularity=granularity)
         # Store the result in the result dict.
         result_dict[term] = copy.deepcopy(num)
     
     # Write the results to file if requested.
     if save_to_file is not None:
         write_results_to_file(save_to_file, result_dict)
+
+    # Add the results to a snapshot store if requested.
+    if append_to_store is not None:
+        append_snapshot(append_to_store, result_dict)
     
     # Plot the results if requested.
     if plot_to_file is not None:
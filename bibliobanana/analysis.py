@@ -0,0 +1,342 @@
+# Part of bibliobanana, by Edwin Dalmaijer
+# https://github.com/esdalmaijer/bibliobanana
+
+import numpy
+
+from .periods import period_to_float
+
+# Default maximum number of floats in all intermediate arrays of a chunk of
+# terms together. 2**24 float64 values take up 128 MB. The bootstrap needs
+# the most: at its peak, _bootstrap_arrays arrays of (terms x resamples)
+# are alive at once (see _bootstrap_slopes and _nan_quantiles).
+_max_chunk_elements = 2**24
+_bootstrap_arrays = 8
+
+
+def results_to_matrix(result_dict, terms=None):
+
+    """Collects the counts of several terms in a single (terms x periods)
+    matrix.
+
+    Arguments
+
+    result_dict     -   dict. Results, as returned by compute_yearly_citations
+                        or load_results_from_file.
+
+    Keyword arguments
+
+    terms           -   list. Terms to include, or None to include all target
+                        terms. Default = None
+
+    Returns
+
+    terms, x, counts-   [list, numpy.ndarray, numpy.ndarray]. The terms
+                        (rows), the time of each period in (fractional) years
+                        (columns), and the counts as float64.
+    """
+
+    if terms is None:
+        terms = list(result_dict["_target"])
+    x = numpy.array([period_to_float(p) for p in result_dict["_year_range"]], \
+        dtype=numpy.float64)
+    counts = numpy.empty((len(terms), x.shape[0]), dtype=numpy.float64)
+    for i, term in enumerate(terms):
+        counts[i,:] = result_dict[term]
+
+    return terms, x, counts
+
+
+def comparison_baseline(result_dict):
+
+    """Returns the average count of the comparison terms in each period
+    (numpy.ndarray), i.e. the baseline that ratios are computed against.
+    """
+
+    if len(result_dict["_comparison"]) == 0:
+        raise Exception("Cannot compute a baseline without comparison terms")
+    terms, x, counts = results_to_matrix(result_dict, \
+        terms=result_dict["_comparison"])
+
+    return numpy.mean(counts, axis=0)
+
+
+def _ratios(counts, baseline):
+
+    # Divide each row by the baseline. Periods in which the baseline is 0 are
+    # NaN, just like they are in plot_yearly_count's ratio plots.
+    ratios = numpy.full(counts.shape, numpy.nan, dtype=numpy.float64)
+    valid = baseline > 0
+    ratios[:,valid] = counts[:,valid] / baseline[valid]
+
+    return ratios
+
+
+def _masked_slopes(y, x):
+
+    # Ordinary least-squares slopes of y against x along the last axis,
+    # ignoring NaNs. y can have any number of leading dimensions; x needs to
+    # broadcast against it. Rows with fewer than two valid values are NaN.
+    w = ~numpy.isnan(y)
+    n = numpy.sum(w, axis=-1)
+    x = numpy.broadcast_to(x, y.shape)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        x_mean = numpy.sum(numpy.where(w, x, 0.0), axis=-1) / n
+        y_mean = numpy.sum(numpy.where(w, y, 0.0), axis=-1) / n
+        dx = numpy.where(w, x - x_mean[...,None], 0.0)
+        dy = numpy.where(w, y - y_mean[...,None], 0.0)
+        slopes = numpy.sum(dx * dy, axis=-1) / numpy.sum(dx * dx, axis=-1)
+    slopes[n < 2] = numpy.nan
+
+    return slopes
+
+
+def _bootstrap_slopes(y, x, multiplicity):
+
+    # Slopes of each row of y (terms x periods) against x, for each bootstrap
+    # resample. Rather than building the resampled data, each resample is
+    # described by how often it contains each period (its multiplicity, with
+    # shape resamples x periods). All sums in the least-squares solution are
+    # then simple matrix products, one per sum.
+    w = (~numpy.isnan(y)).astype(numpy.float64)
+    y = numpy.where(w > 0, y, 0.0)
+    m = multiplicity.T
+    n = w @ m
+    sx = (w * x) @ m
+    sy = y @ m
+    sxx = (w * x * x) @ m
+    sxy = (y * x) @ m
+    # Compute the slopes in place, to limit the number of (terms x
+    # resamples) arrays that are alive at the same time.
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        slopes = sxy
+        slopes *= n
+        sy *= sx
+        slopes -= sy
+        del sy
+        sxx *= n
+        del n
+        sx *= sx
+        sxx -= sx
+        del sx
+        slopes /= sxx
+        del sxx
+    # Resamples with fewer than two distinct periods have no slope.
+    slopes[~numpy.isfinite(slopes)] = numpy.nan
+
+    return slopes
+
+
+def _nan_quantiles(values, q):
+
+    # Quantiles (0-1) along the last axis, ignoring NaNs, by sorting each row
+    # (which puts NaNs last) and interpolating linearly between the ranks.
+    # This is much faster than numpy.nanpercentile for many rows.
+    values = numpy.sort(values, axis=-1)
+    n_valid = numpy.sum(~numpy.isnan(values), axis=-1)
+    result = []
+    for quantile in q:
+        pos = (n_valid - 1) * quantile
+        lo = numpy.clip(numpy.floor(pos).astype(numpy.int64), 0, None)
+        hi = numpy.clip(numpy.ceil(pos).astype(numpy.int64), 0, None)
+        v_lo = numpy.take_along_axis(values, lo[...,None], axis=-1)[...,0]
+        v_hi = numpy.take_along_axis(values, hi[...,None], axis=-1)[...,0]
+        value = v_lo + (v_hi - v_lo) * (pos - lo)
+        value[n_valid == 0] = numpy.nan
+        result.append(value)
+
+    return result
+
+
+def _changepoints(y):
+
+    # Find the single split that best divides each row into two segments
+    # with different means (i.e. that minimises the summed squared error),
+    # using cumulative sums so that all splits are evaluated at once. Each
+    # segment is at least two periods long. NaNs are replaced by the row
+    # mean, so that they don't favour any split.
+    n_terms, n = y.shape
+    index = numpy.full(n_terms, -1, dtype=numpy.int64)
+    shift = numpy.full(n_terms, numpy.nan, dtype=numpy.float64)
+    if n < 4:
+        return index, shift
+    with numpy.errstate(invalid="ignore"):
+        row_mean = numpy.nanmean(y, axis=1)
+    y = numpy.where(numpy.isnan(y), row_mean[:,None], y)
+    # k is the number of periods before the split.
+    k = numpy.arange(2, n-1, dtype=numpy.float64)
+    cs = numpy.cumsum(y, axis=1)
+    before = cs[:,1:n-2]
+    after = cs[:,-1][:,None] - before
+    # The total sum of squares is the same for all splits, so minimising the
+    # error is the same as maximising the explained sum of squares.
+    explained = before**2 / k + after**2 / (n - k)
+    best = numpy.argmax(explained, axis=1)
+    valid = ~numpy.isnan(row_mean)
+    index[valid] = best[valid] + 2
+    rows = numpy.arange(n_terms)
+    shift[valid] = (after[rows,best] / (n - k[best]) \
+        - before[rows,best] / k[best])[valid]
+
+    return index, shift
+
+
+def trend_statistics(counts, x, baseline=None, n_bootstrap=1000, ci=95.0, \
+    chunk_size=None, seed=None):
+
+    """Computes trend statistics for many terms at once. All statistics are
+    computed with vectorised operations on chunks of terms, so that memory
+    use stays bounded however many terms there are.
+
+    Arguments
+
+    counts          -   numpy.ndarray. Counts with shape (terms, periods).
+
+    x               -   numpy.ndarray. Time of each period in (fractional)
+                        years, with shape (periods,).
+
+    Keyword arguments
+
+    baseline        -   numpy.ndarray. Baseline count in each period, with
+                        shape (periods,), e.g. the average count of the
+                        comparison terms. If None, statistics are computed on
+                        the raw counts. Default = None
+
+    n_bootstrap     -   int. Number of bootstrap resamples for the confidence
+                        interval of the growth slope, or 0 to skip it.
+                        Default = 1000
+
+    ci              -   float. Width of the confidence interval (%).
+                        Default = 95.0
+
+    chunk_size      -   int. Number of terms to process at once, or None to
+                        choose it so that all intermediate arrays of a chunk
+                        together stay under 2**24 values (128 MB).
+                        Default = None
+
+    seed            -   int. Seed for the bootstrap's random number
+                        generator, for reproducible intervals. Default = None
+
+    Returns
+
+    stats           -   dict. With a numpy.ndarray of length terms for each
+                        of the following keys:
+                        "mean_ratio": average count relative to baseline.
+                        "slope": growth slope, i.e. the change in the natural
+                            log of the count (ratio) per year. A slope of
+                            0.1 is roughly a 10% increase per year.
+                        "slope_ci_low", "slope_ci_high": bootstrap
+                            confidence interval of the slope.
+                        "changepoint": index of the first period after the
+                            most likely change in level of the log count
+                            (ratio), or -1 if there are too few periods.
+                        "changepoint_shift": difference in the mean log
+                            count (ratio) after and before the changepoint.
+    """
+
+    counts = numpy.asarray(counts, dtype=numpy.float64)
+    x = numpy.asarray(x, dtype=numpy.float64)
+    n_terms, n = counts.shape
+    if baseline is None:
+        baseline = numpy.ones(n, dtype=numpy.float64)
+    else:
+        baseline = numpy.asarray(baseline, dtype=numpy.float64)
+
+    # Choose a chunk size that keeps the bootstrap arrays bounded.
+    if chunk_size is None:
+        chunk_size = max(1, _max_chunk_elements // (_bootstrap_arrays \
+            * max(n, n_bootstrap)))
+
+    # Draw the bootstrap resamples once, and use them for all terms. Each
+    # resample is stored as the number of times each period was drawn.
+    rng = numpy.random.default_rng(seed)
+    if n_bootstrap > 0:
+        resamples = rng.integers(0, n, size=(n_bootstrap, n))
+        multiplicity = numpy.zeros((n_bootstrap, n), dtype=numpy.float64)
+        numpy.add.at(multiplicity, (numpy.arange(n_bootstrap)[:,None], \
+            resamples), 1.0)
+
+    stats = {}
+    for key in ["mean_ratio", "slope", "slope_ci_low", "slope_ci_high", \
+        "changepoint_shift"]:
+        stats[key] = numpy.full(n_terms, numpy.nan, dtype=numpy.float64)
+    stats["changepoint"] = numpy.full(n_terms, -1, dtype=numpy.int64)
+
+    for start in range(0, n_terms, chunk_size):
+        end = min(n_terms, start + chunk_size)
+        ratios = _ratios(counts[start:end,:], baseline)
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            stats["mean_ratio"][start:end] = numpy.nanmean(ratios, axis=1)
+            # Log ratios of 0 are undefined, and are thus ignored.
+            log_ratios = numpy.log(numpy.where(ratios > 0, ratios, numpy.nan))
+        stats["slope"][start:end] = _masked_slopes(log_ratios, x)
+
+        # Bootstrap the slope by resampling periods with replacement.
+        if n_bootstrap > 0:
+            # Centring x doesn't change the slopes, but keeps the sums of
+            # squares small enough to avoid losing precision.
+            boot = _bootstrap_slopes(log_ratios, x - numpy.mean(x), \
+                multiplicity)
+            low, high = _nan_quantiles(boot, \
+                [(100.0-ci)/200.0, 1.0-(100.0-ci)/200.0])
+            stats["slope_ci_low"][start:end] = low
+            stats["slope_ci_high"][start:end] = high
+
+        index, shift = _changepoints(log_ratios)
+        stats["changepoint"][start:end] = index
+        stats["changepoint_shift"][start:end] = shift
+
+    return stats
+
+
+def rank_terms(result_dict, by="slope", n_bootstrap=1000, ci=95.0, \
+    chunk_size=None, seed=None):
+
+    """Ranks the target terms in a result_dict by their growth relative to
+    the average of the comparison terms, or by the growth of their raw counts
+    if there are no comparison terms.
+
+    Arguments
+
+    result_dict     -   dict. Results, as returned by compute_yearly_citations
+                        or load_results_from_file.
+
+    Keyword arguments
+
+    by              -   str. Statistic to rank on, in descending order (see
+                        trend_statistics). Default = "slope"
+
+    n_bootstrap, ci, chunk_size, seed   -   See trend_statistics.
+
+    Returns
+
+    ranking         -   list. One dict per target term, from highest to
+                        lowest, with key "term", the keys of
+                        trend_statistics, and "changepoint_period" (the
+                        period label of the changepoint, or None). Terms for
+                        which the statistic is NaN come last.
+    """
+
+    terms, x, counts = results_to_matrix(result_dict)
+    baseline = None
+    if len(result_dict["_comparison"]) > 0:
+        baseline = comparison_baseline(result_dict)
+    stats = trend_statistics(counts, x, baseline=baseline, \
+        n_bootstrap=n_bootstrap, ci=ci, chunk_size=chunk_size, seed=seed)
+
+    # Sort in descending order, with NaNs last.
+    values = numpy.where(numpy.isnan(stats[by]), -numpy.inf, stats[by])
+    order = numpy.argsort(-values, kind="stable")
+
+    ranking = []
+    for i in order:
+        entry = {"term":terms[i]}
+        for key in stats.keys():
+            entry[key] = stats[key][i].item()
+        if entry["changepoint"] >= 0:
+            entry["changepoint_period"] = \
+                result_dict["_year_range"][entry["changepoint"]]
+        else:
+            entry["changepoint_period"] = None
+        ranking.append(entry)
+
+    return ranking
@@ -0,0 +1,505 @@
+# Part of bibliobanana, by Edwin Dalmaijer
+# https://github.com/esdalmaijer/bibliobanana
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.request import Request, build_opener
+import collections
+import json
+import os
+import socket
+import threading
+import time
+
+from .fanout import get_rate_limiter
+from .get import database_name, get_yearly_count, set_pubmed_api_key
+from .normalise import get_denominator_series
+from .periods import period_range
+
+# The protocol is plain JSON over HTTP. Workers POST to the coordinator:
+# /lease    {"worker":name} -> {"lease":id, "tasks":[[term, period,
+#           is_comparison], ...], "settings":{...}, "timeout":seconds}, or
+#           {"lease":None, "done":bool} if there is no work right now.
+# /renew    {"worker":name, "lease":id} -> {"ok":bool}. ok is False if the
+#           lease has expired and was given to another worker.
+# /result   {"worker":name, "lease":id, "counts":[...]} -> {"ok":bool}
+# /error    {"worker":name, "lease":id, "error":message} -> {"ok":bool}
+# And GET /status returns the progress (see Coordinator.status).
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    # Hands requests over to the Coordinator that owns the server.
+
+    def _reply(self, code, reply):
+        body = json.dumps(reply).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/status":
+            self._reply(200, self.server.coordinator.status())
+        else:
+            self._reply(404, {"error":"unknown path"})
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            message = json.loads(self.rfile.read(length).decode("utf-8"))
+        except ValueError:
+            self._reply(400, {"error":"invalid JSON"})
+            return
+        handlers = {"/lease":self.server.coordinator._lease, \
+            "/renew":self.server.coordinator._renew, \
+            "/result":self.server.coordinator._result, \
+            "/error":self.server.coordinator._error}
+        if self.path not in handlers.keys():
+            self._reply(404, {"error":"unknown path"})
+            return
+        try:
+            reply = handlers[self.path](message)
+        except (IndexError, KeyError, TypeError, ValueError) as e:
+            self._reply(400, {"error":str(e)})
+            return
+        self._reply(200, reply)
+
+    def log_message(self, format, *args):
+        # Requests aren't logged; use verbose on the Coordinator instead.
+        pass
+
+
+class Coordinator(object):
+
+    """Splits the counts for a study into leases, and hands those out to
+    workers (see run_worker) over HTTP, so that a study can be spread over
+    several machines, each with its own rate limit. Leases that aren't
+    finished or renewed in time are handed out again, so workers can come
+    and go (or die) while the study is running.
+
+    Arguments
+
+    search_term     -   str or list. The target term(s).
+
+    start_date      -   int or str. First year or period (inclusive).
+
+    end_date        -   int or str. Last year or period (inclusive).
+
+    Keyword arguments
+
+    comparison_terms-   str or list. The comparison term(s). Default = "banana"
+
+    lease_size      -   int. Number of counts in each lease. Default = 10
+
+    lease_timeout   -   float. Seconds after which a lease that hasn't been
+                        finished or renewed is handed to another worker.
+                        Workers renew their leases at least three times in
+                        this period. Default = 60.0
+
+    max_attempts    -   int. Number of times a lease can fail (i.e. a worker
+                        reports an error) before the study is given up on.
+                        Expired leases don't count as failures. Default = 3
+
+    host            -   str. Address to listen on. Use "0.0.0.0" to accept
+                        workers on other machines. Default = "127.0.0.1"
+
+    port            -   int. Port to listen on, or 0 to pick a free port (see
+                        the url attribute). Default = 8765
+
+    verbose         -   bool. Set to True to print progress. Default = False
+
+    database, exact_phrase, pubmed_field, granularity
+                    -   See get_yearly_count. These are sent to workers along
+                        with each lease.
+    """
+
+    def __init__(self, search_term, start_date, end_date, \
+        comparison_terms="banana", lease_size=10, lease_timeout=60.0, \
+        max_attempts=3, host="127.0.0.1", port=8765, database="pubmed", \
+        exact_phrase=True, pubmed_field="text", granularity="year", \
+        verbose=False):
+
+        # Wrap the search and comparison terms in a list.
+        if type(search_term) not in [tuple, list]:
+            search_term = [search_term]
+        if type(comparison_terms) not in [tuple, list]:
+            comparison_terms = [comparison_terms]
+        self.search_term = list(search_term)
+        self.comparison_terms = list(comparison_terms)
+        self.periods = period_range(start_date, end_date, granularity)
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self.verbose = verbose
+        self._settings = {"database":database_name(database), \
+            "exact_phrase":exact_phrase, "pubmed_field":pubmed_field, \
+            "granularity":granularity}
+
+        # Split all (term, period, is_comparison) tasks into leases. Target
+        # terms come first, so that they are done first.
+        tasks = []
+        for term in self.search_term:
+            for period in self.periods:
+                tasks.append([term, period, False])
+        for term in self.comparison_terms:
+            for period in self.periods:
+                tasks.append([term, period, True])
+        self._leases = [tasks[i:i+lease_size] for i in range(0, len(tasks), \
+            max(1, lease_size))]
+
+        # Lease bookkeeping. Pending leases are waiting for a worker, active
+        # leases map onto [worker, deadline], and counts are stored by
+        # (term, period) as they come in.
+        self._pending = collections.deque(range(len(self._leases)))
+        self._active = {}
+        self._finished = set()
+        self._attempts = {}
+        self._failure = None
+        self._counts = {}
+        self._workers = {}
+        self._lock = threading.Lock()
+        self._all_done = threading.Event()
+        if len(self._leases) == 0:
+            self._all_done.set()
+
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.coordinator = self
+        self._thread = None
+
+    @property
+    def url(self):
+        """URL that workers should connect to."""
+        host, port = self._server.server_address[:2]
+        if host in ["0.0.0.0", ""]:
+            host = socket.gethostname()
+        return "http://{}:{}".format(host, port)
+
+    def start(self):
+
+        """Starts serving leases in a background thread."""
+
+        if self._thread is None:
+            self._thread = threading.Thread( \
+                target=self._server.serve_forever)
+            self._thread.daemon = True
+            self._thread.start()
+            if self.verbose:
+                print("Coordinating {} leases at {}".format( \
+                    len(self._leases), self.url))
+
+    def stop(self):
+
+        """Stops the server. Workers that are still polling will give up
+        once they can't reach it anymore.
+        """
+
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+
+    def _expire(self):
+
+        # Move leases whose deadline has passed back to the front of the
+        # queue. Should be called while holding the lock.
+        now = time.monotonic()
+        for lease_id, (worker, deadline) in list(self._active.items()):
+            if now > deadline:
+                del self._active[lease_id]
+                self._pending.appendleft(lease_id)
+                if self.verbose:
+                    print("Lease {} of worker '{}' expired".format(lease_id, \
+                        worker))
+
+    def _lease(self, message):
+        worker = str(message["worker"])
+        with self._lock:
+            self._workers[worker] = time.time()
+            self._expire()
+            if self._failure is not None or len(self._pending) == 0:
+                return {"lease":None, "done":self._all_done.is_set() \
+                    or self._failure is not None}
+            lease_id = self._pending.popleft()
+            self._active[lease_id] = [worker, \
+                time.monotonic() + self.lease_timeout]
+        return {"lease":lease_id, "tasks":self._leases[lease_id], \
+            "settings":self._settings, "timeout":self.lease_timeout}
+
+    def _lease_id(self, message):
+        # Negative ids would index leases from the end, so every id outside
+        # the range of leases is rejected (with a 400, by the handler).
+        lease_id = int(message["lease"])
+        if lease_id < 0 or lease_id >= len(self._leases):
+            raise ValueError("Unknown lease {}".format(lease_id))
+        return lease_id
+
+    def _renew(self, message):
+        lease_id = self._lease_id(message)
+        with self._lock:
+            if lease_id not in self._active.keys() or \
+                self._active[lease_id][0] != str(message["worker"]):
+                return {"ok":False}
+            self._active[lease_id][1] = time.monotonic() + self.lease_timeout
+        return {"ok":True}
+
+    def _result(self, message):
+        lease_id = self._lease_id(message)
+        counts = message["counts"]
+        if len(counts) != len(self._leases[lease_id]):
+            raise ValueError("Expected {} counts for lease {}, got {}".format( \
+                len(self._leases[lease_id]), lease_id, len(counts)))
+        with self._lock:
+            # Late results from a worker whose lease expired are still
+            # welcome, as long as nobody else has finished it first.
+            if lease_id in self._finished:
+                return {"ok":False}
+            for (term, period, is_comparison), num in \
+                zip(self._leases[lease_id], counts):
+                self._counts[(term, period)] = int(num)
+            self._finished.add(lease_id)
+            if lease_id in self._active.keys():
+                del self._active[lease_id]
+            if lease_id in self._pending:
+                self._pending.remove(lease_id)
+            if len(self._finished) == len(self._leases):
+                self._all_done.set()
+        if self.verbose:
+            print("Lease {} finished by worker '{}' ({}/{})".format(lease_id, \
+                message["worker"], len(self._finished), len(self._leases)))
+        return {"ok":True}
+
+    def _error(self, message):
+        lease_id = self._lease_id(message)
+        with self._lock:
+            # Only the worker that holds the lease can give it up; errors
+            # from a worker whose lease expired (and went to another worker)
+            # are ignored.
+            if lease_id in self._finished or \
+                lease_id not in self._active.keys() or \
+                self._active[lease_id][0] != str(message["worker"]):
+                return {"ok":False}
+            del self._active[lease_id]
+            self._attempts[lease_id] = self._attempts.get(lease_id, 0) + 1
+            if self._attempts[lease_id] >= self.max_attempts:
+                self._failure = "Lease {} failed {} times, last on worker " \
+                    "'{}': {}".format(lease_id, self._attempts[lease_id], \
+                    message["worker"], message["error"])
+                self._all_done.set()
+            else:
+                self._pending.append(lease_id)
+        if self.verbose:
+            print("Lease {} failed on worker '{}': {}".format(lease_id, \
+                message["worker"], message["error"]))
+        return {"ok":True}
+
+    def status(self):
+
+        """Returns the progress as a dict with keys "leases", "pending",
+        "active", and "finished" (numbers of leases), "workers" (a dict that
+        maps each worker's name onto the last time it asked for a lease),
+        and "failure" (an error message, or None).
+        """
+
+        with self._lock:
+            self._expire()
+            return {"leases":len(self._leases), "pending":len(self._pending), \
+                "active":len(self._active), "finished":len(self._finished), \
+                "workers":dict(self._workers), "failure":self._failure}
+
+    def wait(self, timeout=None):
+
+        """Waits until all leases are finished, for at most timeout seconds
+        (or indefinitely if timeout is None). Returns True if they are, and
+        False if the time ran out. Raises a RuntimeError if a lease failed
+        too often.
+        """
+
+        t0 = time.monotonic()
+        while not self._all_done.is_set():
+            # Expired leases are also picked up here, so that they are
+            # counted as pending even when no worker is asking for work.
+            with self._lock:
+                self._expire()
+            remaining = None
+            if timeout is not None:
+                remaining = timeout - (time.monotonic() - t0)
+                if remaining <= 0:
+                    break
+            self._all_done.wait(min(1.0, remaining) if remaining is not None \
+                else 1.0)
+        if self._failure is not None:
+            raise RuntimeError(self._failure)
+
+        return self._all_done.is_set()
+
+    def result(self):
+
+        """Returns the counts as a result_dict, in the same format as
+        compute_yearly_citations. Raises a RuntimeError if not all leases
+        have been finished yet.
+        """
+
+        with self._lock:
+            if len(self._finished) < len(self._leases):
+                raise RuntimeError("Only {} of {} leases are finished".format( \
+                    len(self._finished), len(self._leases)))
+            result_dict = {"_target":list(self.search_term), \
+                "_comparison":list(self.comparison_terms), \
+                "_year_range":list(self.periods), "_query":{ \
+                "database":self._settings["database"], \
+                "pubmed_field":self._settings["pubmed_field"], \
+                "exact_phrase":self._settings["exact_phrase"]}}
+            for term in self.search_term + self.comparison_terms:
+                result_dict[term] = [self._counts[(term, period)] \
+                    for period in self.periods]
+
+        return result_dict
+
+
+def _post(url, path, message, timeout=30.0):
+
+    # Send a JSON message to the coordinator, and return its JSON reply.
+    request = Request(url=url.rstrip("/")+path, \
+        data=json.dumps(message).encode("utf-8"), \
+        headers={"Content-Type":"application/json"})
+    handler = build_opener().open(request, timeout=timeout)
+
+    return json.loads(handler.read().decode("utf-8"))
+
+
+def run_worker(url, name=None, api_key=None, rate=None, local_index=None, \
+    poll_interval=1.0, connect_timeout=30.0, verbose=False):
+
+    """Fetches counts for a Coordinator until all its leases are finished.
+    Run this on each machine (or in several processes on the same machine),
+    for example with: python -m bibliobanana.worker URL [API_KEY]
+
+    Arguments
+
+    url             -   str. URL of the coordinator, e.g.
+                        "http://192.168.1.10:8765" (see Coordinator.url).
+
+    Keyword arguments
+
+    name            -   str. Name of this worker, which needs to be unique.
+                        Defaults to hostname-pid. Default = None
+
+    api_key         -   str. NCBI API key for PubMed requests from this
+                        worker (see bibliobanana.get.set_pubmed_api_key), or
+                        None to use the NCBI_API_KEY environment variable.
+                        Default = None
+
+    rate            -   float. Maximum number of requests per second from
+                        this worker, shared with anything else in the same
+                        process that requests counts from the same database
+                        (see bibliobanana.fanout.get_rate_limiter). Defaults
+                        to 3 for PubMed (10 with an API key) and 0.5 for
+                        Google Scholar. Default = None
+
+    local_index     -   str. Path to the local index on this machine, for
+                        studies that use the "local" database. Default = None
+
+    poll_interval   -   float. Seconds to wait before asking again when all
+                        remaining leases are held by other workers.
+                        Default = 1.0
+
+    connect_timeout -   float. Seconds to keep trying when the coordinator
+                        can't be reached, after which the worker stops.
+                        Default = 30.0
+
+    verbose         -   bool. Set to True to print progress. Default = False
+
+    Returns
+
+    n_counts        -   int. Number of counts this worker has delivered.
+    """
+
+    if name is None:
+        name = "{}-{}".format(socket.gethostname(), os.getpid())
+    if api_key is not None:
+        set_pubmed_api_key(api_key)
+    message = {"worker":name}
+    n_counts = 0
+    unreachable_since = None
+
+    while True:
+        # Ask for a lease. The coordinator might not be up yet, or it might
+        # have stopped after the study finished.
+        try:
+            reply = _post(url, "/lease", message)
+            unreachable_since = None
+        except (OSError, ValueError):
+            if unreachable_since is None:
+                unreachable_since = time.monotonic()
+            if time.monotonic() - unreachable_since > connect_timeout:
+                break
+            time.sleep(poll_interval)
+            continue
+        if reply["lease"] is None:
+            if reply["done"]:
+                break
+            time.sleep(poll_interval)
+            continue
+
+        # Use the shared rate limit for the lease's database. Only requests
+        # that are actually sent wait for it; cached counts don't.
+        settings = reply["settings"]
+        database = settings.pop("database")
+        database_rate = rate
+        if database_rate is None and database == "pubmed" and \
+            (api_key is not None or \
+            os.environ.get("NCBI_API_KEY", None) is not None):
+            database_rate = 10.0
+        limiter = get_rate_limiter(database, database_rate)
+
+        # Fetch the counts, renewing the lease as we go.
+        lease_id = reply["lease"]
+        lease_message = {"worker":name, "lease":lease_id}
+        renew_every = reply["timeout"] / 3.0
+        last_renewal = time.monotonic()
+        counts = []
+        try:
+            for term, period, is_comparison in reply["tasks"]:
+                if time.monotonic() - last_renewal > renew_every:
+                    if not _post(url, "/renew", lease_message)["ok"]:
+                        # The lease went to someone else; drop it.
+                        counts = None
+                        break
+                    last_renewal = time.monotonic()
+                if is_comparison:
+                    num = get_denominator_series(term, period, period, \
+                        database=database, pause=0.0, limiter=limiter, \
+                        local_index=local_index, **settings)[0]
+                else:
+                    num = get_yearly_count(term, period, period, \
+                        database=database, pause=0.0, limiter=limiter, \
+                        local_index=local_index, **settings)[0]
+                counts.append(num)
+        except Exception as e:
+            if verbose:
+                print("Lease {} failed: {}".format(lease_id, e))
+            try:
+                _post(url, "/error", {"worker":name, "lease":lease_id, \
+                    "error":str(e)})
+            except (OSError, ValueError):
+                pass
+            time.sleep(poll_interval)
+            continue
+        if counts is None:
+            continue
+
+        try:
+            if _post(url, "/result", {"worker":name, "lease":lease_id, \
+                "counts":counts})["ok"]:
+                n_counts += len(counts)
+        except (OSError, ValueError):
+            # The coordinator will hand the lease out again when it expires.
+            pass
+        if verbose:
+            print("Finished lease {} ({} counts in total)".format(lease_id, \
+                n_counts))
+
+    return n_counts
+
@@ -0,0 +1,125 @@
+# Part of bibliobanana, by Edwin Dalmaijer
+# https://github.com/esdalmaijer/bibliobanana
+
+
+def encode_varints(values):
+
+    """Encodes a sequence of non-negative integers as variable-length
+    integers (LEB128): seven bits per byte, with the high bit set on all but
+    the last byte of each number. Small numbers thus take a single byte.
+
+    Arguments
+
+    values          -   iterable of int. Non-negative integers to encode.
+
+    Returns
+
+    data            -   bytes. The encoded integers.
+    """
+
+    data = bytearray()
+    for value in values:
+        if value < 0:
+            raise Exception("Cannot encode negative value {} as varint" \
+                .format(value))
+        while value > 0x7F:
+            data.append((value & 0x7F) | 0x80)
+            value >>= 7
+        data.append(value)
+
+    return bytes(data)
+
+
+def decode_varints(data, offset=0, count=None):
+
+    """Decodes variable-length integers as written by encode_varints.
+
+    Arguments
+
+    data            -   bytes. The encoded integers (or a memoryview or mmap
+                        on them).
+
+    Keyword arguments
+
+    offset          -   int. Index of the byte to start decoding at.
+                        Default = 0
+
+    count           -   int. Number of integers to decode, or None to decode
+                        until the end of data. Default = None
+
+    Returns
+
+    values, offset  -   [list, int]. The decoded integers, and the index of
+                        the first byte after the last decoded integer.
+    """
+
+    values = []
+    value = 0
+    shift = 0
+    n = len(data)
+    while offset < n:
+        if count is not None and len(values) >= count:
+            break
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = 0
+            shift = 0
+
+    return values, offset
+
+
+def delta_encode(values):
+
+    """Returns the differences between consecutive values, starting with the
+    first value itself. Sorted sequences become small numbers, which encode
+    compactly as varints.
+    """
+
+    deltas = []
+    previous = 0
+    for value in values:
+        deltas.append(value - previous)
+        previous = value
+
+    return deltas
+
+
+def delta_decode(deltas):
+
+    """Reverses delta_encode, returning the cumulative sums of deltas.
+    """
+
+    values = []
+    total = 0
+    for delta in deltas:
+        total += delta
+        values.append(total)
+
+    return values
+
+
+def zigzag_encode(value):
+
+    """Maps signed integers onto non-negative integers (0, -1, 1, -2, 2 onto
+    0, 1, 2, 3, 4), so that deltas that can be negative can be stored as
+    varints too.
+    """
+
+    if value >= 0:
+        return value << 1
+    return ((-value) << 1) - 1
+
+
+def zigzag_decode(value):
+
+    """Reverses zigzag_encode.
+    """
+
+    if value & 1:
+        return -((value + 1) >> 1)
+    return value >> 1
@@ -0,0 +1,258 @@
+# Part of bibliobanana, by Edwin Dalmaijer
+# https://github.com/esdalmaijer/bibliobanana
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+from .get import database_name, get_yearly_count
+from .normalise import get_denominator_series
+from .periods import period_range
+
+# Default number of requests per second, and number of requests that can be
+# in flight at the same time, for each database. PubMed allows 3 requests
+# per second without an API key. Google Scholar doesn't publish a limit, but
+# blocks anything that looks automated, so it's kept very slow.
+_default_rates = {"pubmed":3.0, "google scholar":0.5, "local":1000.0}
+_default_workers = {"pubmed":3, "google scholar":1, "local":1}
+
+# Rate limiters by database, shared by everything in this process that
+# requests counts, so that simultaneous studies together stay under the
+# limit (see get_rate_limiter).
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+class RateLimiter(object):
+
+    """Spaces out calls to wait() so that they happen at most rate times per
+    second, across all threads that share the limiter.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate):
+        with self._lock:
+            self.interval = 1.0 / rate
+
+    def wait(self):
+        # Reserve the next free slot, and then sleep until it comes up.
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def get_rate_limiter(database, rate=None):
+
+    """Returns the RateLimiter for database that is shared by all functions
+    in this process that request counts from it, so that running several
+    studies at the same time doesn't multiply the request rate.
+
+    Arguments
+
+    database        -   str. Name of the database (see get_yearly_count).
+
+    Keyword arguments
+
+    rate            -   float. Maximum number of requests per second. This
+                        replaces the limiter's current rate, so the most
+                        recently passed rate applies to everything that
+                        shares the limiter. Defaults to 3 for PubMed and 0.5
+                        for Google Scholar when the limiter is created.
+                        Default = None
+
+    Returns
+
+    limiter         -   RateLimiter. The shared limiter.
+    """
+
+    database = database_name(database)
+    with _rate_limiters_lock:
+        if database not in _rate_limiters.keys():
+            if rate is None:
+                rate = _default_rates.get(database, 1.0)
+            _rate_limiters[database] = RateLimiter(rate)
+        elif rate is not None:
+            _rate_limiters[database].set_rate(rate)
+
+        return _rate_limiters[database]
+
+
+def _run_backend(database, tasks, rate, n_workers, kwargs, results, errors):
+
+    # Run all (term, period, is_comparison) tasks for one database, in its own
+    # thread pool and under the database's shared rate limit. Only requests
+    # that are actually sent wait for the limiter; cached counts don't. The
+    # first error stops the remaining tasks for this database only.
+    limiter = get_rate_limiter(database, rate)
+    failed = threading.Event()
+
+    def run_task(task):
+        term, period, is_comparison = task
+        if failed.is_set():
+            return
+        try:
+            if is_comparison:
+                num = get_denominator_series(term, period, period, \
+                    database=database, pause=0.0, limiter=limiter, \
+                    **kwargs)[0]
+            else:
+                num = get_yearly_count(term, period, period, \
+                    database=database, pause=0.0, limiter=limiter, \
+                    **kwargs)[0]
+        except Exception as e:
+            if not failed.is_set():
+                failed.set()
+                errors[database] = str(e)
+            return
+        results[(term, period)] = num
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        list(executor.map(run_task, tasks))
+
+
+def compute_multi_source_citations(search_term, start_date, end_date, \
+    comparison_terms="banana", databases=("pubmed", "google scholar"), \
+    rates=None, n_workers=None, exact_phrase=True, pubmed_field="text", \
+    granularity="year", verbose=False, local_index=None):
+
+    """Counts the same terms in several databases at once. Each database gets
+    its own pool of threads and its own rate limit, so that a slow database
+    (e.g. Google Scholar) doesn't hold up a fast one (e.g. PubMed). The rate
+    limits are shared with other calls in the same process (see
+    get_rate_limiter).
+
+    Arguments
+
+    search_term     -   str or list. The target term(s).
+
+    start_date      -   int or str. First year or period (inclusive).
+
+    end_date        -   int or str. Last year or period (inclusive).
+
+    Keyword arguments
+
+    comparison_terms-   str or list. The comparison term(s). These are
+                        fetched through the shared cache in
+                        bibliobanana.normalise. Default = "banana"
+
+    databases       -   list. Databases to query (see get_yearly_count).
+                        Default = ("pubmed", "google scholar")
+
+    rates           -   dict. Maximum number of requests per second for each
+                        database, e.g. {"pubmed":10.0} if you have an NCBI
+                        API key. Databases that aren't in the dict keep the
+                        rate of their shared limiter, which starts at 3 for
+                        PubMed, and 0.5 for Google Scholar (see
+                        get_rate_limiter). Default = None
+
+    n_workers       -   dict. Number of simultaneous requests for each
+                        database. Defaults to 3 for PubMed, and 1 for Google
+                        Scholar. Default = None
+
+    exact_phrase, pubmed_field, granularity, verbose, local_index
+                    -   See get_yearly_count.
+
+    Returns
+
+    result          -   dict. With key "_sources" (list of database names),
+                        "_errors" (dict that maps the name of each database
+                        that failed onto its error message), and one
+                        result_dict (as returned by compute_yearly_citations)
+                        for each database, under its name. Databases that
+                        failed have None instead of a result_dict. Use
+                        flatten_sources to combine them into a single
+                        result_dict.
+    """
+
+    # Wrap the search and comparison terms in a list.
+    if type(search_term) not in [tuple, list]:
+        search_term = [search_term]
+    if type(comparison_terms) not in [tuple, list]:
+        comparison_terms = [comparison_terms]
+    search_term = list(search_term)
+    comparison_terms = list(comparison_terms)
+    databases = [database_name(database) for database in databases]
+    if rates is None:
+        rates = {}
+    if n_workers is None:
+        n_workers = {}
+
+    # Create the list of tasks. Every database gets the same tasks: all
+    # periods of all target terms, and then of all comparison terms.
+    periods = period_range(start_date, end_date, granularity)
+    tasks = []
+    for term in search_term:
+        for period in periods:
+            tasks.append((term, period, False))
+    for term in comparison_terms:
+        for period in periods:
+            tasks.append((term, period, True))
+    kwargs = {"exact_phrase":exact_phrase, "pubmed_field":pubmed_field, \
+        "granularity":granularity, "verbose":verbose, \
+        "local_index":local_index}
+
+    # Start one scheduler thread for each database, and wait for all of them
+    # to finish.
+    results = {}
+    errors = {}
+    threads = []
+    for database in databases:
+        results[database] = {}
+        rate = rates.get(database, None)
+        workers = n_workers.get(database, _default_workers.get(database, 1))
+        t = threading.Thread(target=_run_backend, args=(database, tasks, \
+            rate, workers, kwargs, results[database], errors))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+
+    # Assemble the result dicts.
+    result = {"_sources":databases, "_errors":errors}
+    for database in databases:
+        if database in errors.keys():
+            if verbose:
+                print("Could not get results from {}: {}".format(database, \
+                    errors[database]))
+            result[database] = None
+            continue
+        result_dict = {"_target":search_term, \
+            "_comparison":comparison_terms, "_year_range":periods, \
+            "_query":{"database":database, "pubmed_field":pubmed_field, \
+            "exact_phrase":exact_phrase, "local_index":local_index}}
+        for term in search_term + comparison_terms:
+            result_dict[term] = [results[database][(term, period)] \
+                for period in periods]
+        result[database] = result_dict
+
+    return result
+
+
+def flatten_sources(result):
+
+    """Combines the per-database results of compute_multi_source_citations
+    into a single result_dict, in which each term is named after its term
+    and database, e.g. "banana (pubmed)". This can be plotted, or written to
+    file, like any other result_dict. Databases that failed are left out.
+    """
+
+    flat = {"_target":[], "_comparison":[], "_year_range":None}
+    for database in result["_sources"]:
+        if result[database] is None:
+            continue
+        flat["_year_range"] = list(result[database]["_year_range"])
+        for role in ["_target", "_comparison"]:
+            for term in result[database][role]:
+                name = "{} ({})".format(term, database)
+                flat[role].append(name)
+                flat[name] = list(result[database][term])
+
+    return flat
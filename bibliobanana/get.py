@@ -3,9 +3,103 @@
 
 from bs4 import BeautifulSoup
 from urllib.request import Request, build_opener
-import json, re, time, urllib
+import json, os, re, threading, time, urllib
 
-def get_num_results_scholar(search_term, start_date, end_date):
+from .local import load_local_index, tokenise
+from .periods import parse_period, period_children, period_range
+from .phrase import count_articles, count_phrase
+
+# Requests that are currently being made, by (database, field, term, year).
+# Threads that ask for a request that is already in flight wait for it to
+# finish, and share its result, rather than making the same request again.
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+# Counts of the total number of requests, and of those that were coalesced
+# into an in-flight request.
+_single_flight_stats = {"requests":0, "coalesced":0}
+
+# Search term that stands for all records in a database, e.g. to normalise
+# counts by the total number of publications per year.
+TOTAL = "_total"
+
+# Sub-yearly counts, by (database, field, term), and then by period. Sub-
+# yearly periods are summed from finer ones when all of those are known, so
+# that e.g. quarterly views of monthly results cost no requests. Years are
+# never summed (see get_yearly_count).
+_period_cache = {}
+_period_cache_lock = threading.Lock()
+
+# NCBI API key, which raises the PubMed rate limit from 3 to 10 requests per
+# second. Taken from the NCBI_API_KEY environment variable by default.
+_pubmed_api_key = os.environ.get("NCBI_API_KEY", None)
+
+
+def _single_flight(key, function, *args, **kwargs):
+
+    # Check whether an identical request is already in flight. If so, we will
+    # wait for it; otherwise, this thread becomes the one to make it. Returns
+    # the result, and whether this thread made the request itself (so that
+    # only threads that did have to pause afterwards).
+    with _in_flight_lock:
+        _single_flight_stats["requests"] += 1
+        if key in _in_flight.keys():
+            call = _in_flight[key]
+            _single_flight_stats["coalesced"] += 1
+            leader = False
+        else:
+            call = {"done":threading.Event(), "result":None, "error":None}
+            _in_flight[key] = call
+            leader = True
+
+    # Wait for the in-flight request, and share its outcome.
+    if not leader:
+        call["done"].wait()
+        if call["error"] is not None:
+            raise call["error"]
+        return call["result"], False
+
+    # Make the request. The key is removed before waiting threads are
+    # released, so that later requests are sent anew.
+    try:
+        call["result"] = function(*args, **kwargs)
+    except Exception as e:
+        call["error"] = e
+        raise
+    finally:
+        with _in_flight_lock:
+            del _in_flight[key]
+        call["done"].set()
+
+    return call["result"], True
+
+
+def get_single_flight_stats(reset=False):
+
+    """Returns how many PubMed and Google Scholar requests were made, and how
+    many of those were coalesced into identical requests that were already in
+    flight in another thread (and thus did not cost a network call).
+
+    Keyword arguments
+
+    reset           -   bool. Set to True to reset the counts to 0 after
+                        returning them. Default = False
+
+    Returns
+
+    stats           -   dict. With keys "requests" and "coalesced" (int).
+    """
+
+    with _in_flight_lock:
+        stats = dict(_single_flight_stats)
+        if reset:
+            _single_flight_stats["requests"] = 0
+            _single_flight_stats["coalesced"] = 0
+
+    return stats
+
+
+def get_num_results_scholar(search_term, start_date, end_date, \
+    limiter=None):
     """Helper method, sends HTTP request and returns response payload.
     
     Arguments
@@ -16,6 +110,11 @@ def get_num_results_scholar(search_term, start_date, end_date):
 
     end_date        -   int. Year until which to count results for (inclusive).
 
+    Keyword arguments
+
+    limiter         -   RateLimiter. Waited for before the request is sent
+                        (see get_yearly_count). Default = None
+
     Returns
     
     num, success    -   [int, bool]. num gives the count of papers mentioning 
@@ -25,12 +124,35 @@ def get_num_results_scholar(search_term, start_date, end_date):
                         be a str clarifying the error.
     """
 
+    return _request_num_results_scholar(search_term, start_date, end_date, \
+        limiter=limiter)[0]
+
+
+def _request_num_results_scholar(search_term, start_date, end_date, \
+    limiter=None):
+
+    # Identical concurrent requests share a single network call. Returns the
+    # (num, success) result, and whether this thread sent the request.
+    return _single_flight(("google scholar", None, search_term, \
+        (start_date, end_date)), _fetch_num_results_scholar, search_term, \
+        start_date, end_date, limiter=limiter)
+
+
+def _fetch_num_results_scholar(search_term, start_date, end_date, \
+    limiter=None):
+
     # This is based on a script by Volker Strobel, which was later improved by 
     # Patrick Hofmann. For the original, see:
     # https://github.com/Pold87/academic-keyword-occurrence
     #
     # Further changes made by Edwin Dalmaijer.
 
+    # Wait for a free slot under the rate limit. This happens here, rather
+    # than in get_yearly_count, so that requests that are coalesced into
+    # another thread's request don't use up a slot.
+    if limiter is not None:
+        limiter.wait()
+
     # Open website and read html
     user_agent = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/48.0.2564.109 Safari/537.36'
     query_params = { \
@@ -74,7 +196,47 @@ def get_num_results_scholar(search_term, start_date, end_date):
     return num_results, success
 
 
-def get_num_results_pubmed(search_term, year, field="word"):
+def set_pubmed_api_key(api_key):
+
+    """Sets the NCBI API key that is sent along with all PubMed requests in
+    this process, or stops sending one if api_key is None.
+    """
+
+    global _pubmed_api_key
+    _pubmed_api_key = api_key
+
+
+def get_num_results_pubmed(search_term, year, field="word", limiter=None):
+
+    return _request_num_results_pubmed(search_term, year, field=field, \
+        limiter=limiter)[0]
+
+
+def _request_num_results_pubmed(search_term, year, field="word", \
+    limiter=None):
+
+    # Identical concurrent requests share a single network call. Returns the
+    # (num, success) result, and whether this thread sent the request.
+    return _single_flight(("pubmed", field, search_term, year), \
+        _fetch_num_results_pubmed, search_term, year, field=field, \
+        limiter=limiter)
+
+
+def _pdat_query(period):
+
+    # Construct the publication date part of a PubMed query. Years and months
+    # can be queried directly (e.g. 2020[pdat] and 2020/03[pdat]), quarters
+    # need a range of months.
+    granularity, year, number = parse_period(period)
+    if granularity == "year":
+        return "{}[pdat]".format(year)
+    elif granularity == "month":
+        return "{}/{:02d}[pdat]".format(year, number)
+    return "{}/{:02d}[pdat]:{}/{:02d}[pdat]".format(year, 3*number-2, year, \
+        3*number)
+
+
+def _fetch_num_results_pubmed(search_term, year, field="word", limiter=None):
     
     # If you're reading this, thinking "What could I do to change the search
     # fields? The following are valid fields in Entrez:
@@ -96,13 +258,24 @@ def get_num_results_pubmed(search_term, year, field="word"):
     # [TIAB]    - Title/Abstract
     # [UID]     - UID
 
-    # Make the search term URL-friendly.
-    url_search_term = urllib.parse.quote(search_term)
-
-    # Construct the query string.
+    # Construct the query string. Without a search term, all records from
+    # the requested year are counted.
     url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi?" + \
-        "db=pubmed&retmode=json&rettype=count&" + \
-        "term={}[{}]+AND+{}[pdat]".format(url_search_term, field, year)
+        "db=pubmed&retmode=json&rettype=count&"
+    if search_term is None:
+        url += "term={}".format(_pdat_query(year))
+    else:
+        # Make the search term URL-friendly.
+        url_search_term = urllib.parse.quote(search_term)
+        url += "term={}[{}]+AND+{}".format(url_search_term, field, \
+            _pdat_query(year))
+    if _pubmed_api_key is not None:
+        url += "&api_key={}".format(urllib.parse.quote(_pubmed_api_key))
+
+    # Wait for a free slot under the rate limit (see
+    # _fetch_num_results_scholar).
+    if limiter is not None:
+        limiter.wait()
     
     # Make the search.
     opener = build_opener()
@@ -125,8 +298,155 @@ def get_num_results_pubmed(search_term, year, field="word"):
     return num_results, success
 
 
+def get_num_results_local(search_term, year, index_path, field="word"):
+
+    """Counts the number of articles in a local index that contain
+    search_term in a specific year.
+
+    Arguments
+
+    search_term     -   str. Search term to count hits for. Wrap the term in
+                        quotes to count exact phrases. Pass None to count
+                        all articles.
+
+    year            -   int. Year to count results for.
+
+    index_path      -   str. Path to a count index file (built with
+                        bibliobanana.local.ingest_pubmed_files), or to a
+                        phrase index directory (built with
+                        bibliobanana.phrase.build_phrase_index). Count
+                        indices only support single words; phrase indices
+                        also support multi-word terms, but not MeSH.
+
+    Keyword arguments
+
+    field           -   str. PubMed field to search in. Text fields ("word",
+                        "text", "tiab", "all") are matched against title and
+                        abstract tokens; "mesh" against all MeSH descriptor
+                        names, and "majr" against the descriptors that are a
+                        major topic of the article. Default = "word"
+
+    Returns
+
+    num, success    -   [int, bool]. num gives the count of papers mentioning
+                        search_term in the given year. success == False when
+                        the term could not be counted, in which case num will
+                        be a str clarifying the error.
+    """
+
+    # Find the section of the index that corresponds with the field.
+    if field.lower() in ["word", "text", "tiab", "all"]:
+        section = "text"
+    elif field.lower() in ["mesh", "majr"]:
+        section = field.lower()
+    else:
+        return "Field '{}' is not supported by the local index".format( \
+            field), False
+
+    # Phrase indices are directories. Quoted terms are exact phrases, just
+    # like they are on PubMed.
+    if os.path.isdir(index_path) and search_term is None:
+        try:
+            counts = count_articles(index_path)
+        except Exception as e:
+            return str(e), False
+        return counts.get(str(year), 0), True
+    elif os.path.isdir(index_path):
+        if section != "text":
+            return "Phrase indices do not support field '{}'".format( \
+                field), False
+        exact_phrase = search_term.startswith("\"") and \
+            search_term.endswith("\"")
+        try:
+            counts = count_phrase(index_path, search_term.replace("\"", ""), \
+                exact_phrase=exact_phrase)
+        except Exception as e:
+            return str(e), False
+        return counts.get(str(year), 0), True
+
+    # Load the count index (this is cached after the first call).
+    try:
+        index = load_local_index(index_path)
+    except Exception as e:
+        return str(e), False
+
+    # Count all articles if there is no search term.
+    if search_term is None:
+        return index["total"].get(str(year), 0), True
+
+    # Indices from older versions of bibliobanana don't record major topics.
+    if section not in index.keys():
+        return "The local index does not support field '{}'; ".format( \
+            field) + "please rebuild it", False
+
+    # MeSH terms are stored whole, text terms as single tokens.
+    search_term = search_term.replace("\"", "")
+    if section in ["mesh", "majr"]:
+        term = search_term.lower()
+    else:
+        tokens = tokenise(search_term)
+        if len(tokens) != 1:
+            return "The local count index can only count single words, " + \
+                "not '{}'; use a phrase index instead".format(search_term), \
+                False
+        term = tokens[0]
+
+    # Look up the count. Terms or years that do not occur count as 0.
+    num_results = index[section].get(term, {}).get(str(year), 0)
+
+    return num_results, True
+
+
+def _get_cached_count(key, period):
+
+    # Return the cached count for a period, or the sum of its children if
+    # those are all known, or None if neither is the case.
+    with _period_cache_lock:
+        if key in _period_cache.keys() and period in _period_cache[key]:
+            return _period_cache[key][period]
+    children = period_children(period)
+    if children is None:
+        return None
+    total = 0
+    for child in children:
+        num = _get_cached_count(key, child)
+        if num is None:
+            return None
+        total += num
+
+    return total
+
+
+def clear_period_cache():
+
+    """Forgets all cached sub-yearly counts, so that they are requested anew.
+    """
+
+    with _period_cache_lock:
+        _period_cache.clear()
+
+
+def database_name(database):
+
+    """Returns the standard name ("google scholar", "pubmed", or "local") for
+    any of the accepted aliases of a database, e.g. "scholar" or "medline".
+    Unknown names are returned as they are.
+    """
+
+    if database.lower() in ["google scholar", "googlescholar", "scholar", \
+        "gscholar"]:
+        return "google scholar"
+    elif database.lower() in ["pubmed", "ncbi", "pm", "medline"]:
+        return "pubmed"
+    elif database.lower() in ["local", "offline"]:
+        return "local"
+
+    return database
+
+
 def get_yearly_count(search_term, start_date, end_date, database="pubmed", \
-    exact_phrase=True, pubmed_field="word", pause=1.0, verbose=False):
+    exact_phrase=True, pubmed_field="word", pause=1.0, verbose=False, \
+    local_index=None, granularity="year", limiter=None):
     
     """Returns a list with the yearly hit count for search_term from
     start_date until end_date (inclusive).
@@ -134,10 +454,16 @@ def get_yearly_count(search_term, start_date, end_date, database="pubmed", \
     Arguments
     
     search_term     -   str. Search term to count Google Scholar hits for.
+                        Use bibliobanana.get.TOTAL ("_total") to count all
+                        records in PubMed or a local index.
 
     start_date      -   int. Year from which to count results for (inclusive).
+                        For sub-yearly granularities, this can also be a
+                        period label, e.g. "2020-03" for months.
 
     end_date        -   int. Year until which to count results for (inclusive).
+                        For sub-yearly granularities, this can also be a
+                        period label, e.g. "2020-Q2" for quarters.
     
     Keyword arguments
     
@@ -145,6 +471,7 @@ def get_yearly_count(search_term, start_date, end_date, database="pubmed", \
                         Currently available are:
                             "scholar" for Google Scholar
                             "pubmed" for pubmed
+                            "local" for a local index of PubMed files
                         Please note that all databases come with specific rate
                         limits, which you should stay under to prevent getting
                         blocked. Google Scholar's limit seems particularly
@@ -164,42 +491,100 @@ def get_yearly_count(search_term, start_date, end_date, database="pubmed", \
     verbose         -   bool. Set to True to see output printed to the console
                         with each year's count as it comes in. Default = False
 
+    local_index     -   str. Path to a local count index or phrase index (see
+                        get_num_results_local). Only used (and required)
+                        when database is "local".
+                        Default = None
+
+    granularity     -   str. "year", "quarter", or "month". Sub-yearly
+                        counts are only available from PubMed. They are
+                        cached for the rest of the session (see
+                        clear_period_cache), and quarterly counts are summed
+                        from monthly ones where possible rather than
+                        requested. Yearly counts are always requested, as
+                        some records only have a publication year, and are
+                        thus included in yearly counts from PubMed, but not
+                        in any monthly or quarterly counts. Use
+                        bibliobanana.periods.aggregate_results to sum
+                        sub-yearly counts into years instead.
+                        Default = "year"
+
+    limiter         -   RateLimiter. Limiter to wait for before each request
+                        that is actually sent, e.g. one shared by several
+                        threads (see bibliobanana.fanout.get_rate_limiter).
+                        Cached and local counts don't wait for it, and
+                        neither do requests that are shared with an identical
+                        one from another thread. Default = None
+
     Returns
     
-    result          -   list. The yearly count of papers mentioning "banana",
-                        with len(result) == end_date - start_date.
+    result          -   list. The count of papers mentioning "banana" for
+                        each period from start_date until end_date (see
+                        bibliobanana.periods.period_range).
     """
     
     # Add quotes if required.
-    if exact_phrase:
+    if search_term == TOTAL:
+        pass
+    elif exact_phrase:
         search_term = "\"{}\"".format(search_term)
     
     # Find the correct database.
-    if database.lower() in ["google scholar", "googlescholar", "scholar", \
-        "gscholar"]:
-        database = "google scholar"
-    elif database.lower() in ["pubmed", "ncbi", "pm", "medline"]:
-        database = "pubmed"
+    database = database_name(database)
+    if database == "local":
+        if local_index is None:
+            raise Exception("A local_index is required for the local " + \
+                "database.")
+
+    # Only PubMed supports sub-yearly publication dates.
+    periods = period_range(start_date, end_date, granularity)
+    if granularity != "year" and database != "pubmed":
+        raise Exception("Granularity '{}' is not supported for {}".format( \
+            granularity, database))
+    if search_term == TOTAL and database == "google scholar":
+        raise Exception("Google Scholar cannot count all records")
+    cache_key = (database, pubmed_field, search_term)
     
     # Optionally report the start.
     if verbose:
         print("Searching for '{}' from {} until {}".format(search_term, \
             start_date, end_date))
 
+    # The total number of records is counted by not passing a search term.
+    if search_term == TOTAL:
+        search_term = None
+
     # Create an empty list to store results in.
     result = []
     # Loop through all dates (inclusive).
-    for date in range(start_date, end_date + 1):
+    for date in periods:
+        # Use known counts where possible. Yearly counts are always
+        # requested directly, as records that only have a publication year
+        # are missing from the sum of their months.
+        num_result = None
+        if database == "pubmed" and granularity != "year":
+            num_result = _get_cached_count(cache_key, date)
+        fetched = num_result is None
+        # Only requests that this thread sent itself are followed by a
+        # pause; not those that were shared with another thread's request.
+        sent = False
+        if not fetched:
+            success = True
         # Google Scholar
-        if database == "google scholar":
+        elif database == "google scholar":
             # Count the number of search results for this year.
-            num_result, success = get_num_results_scholar(search_term, date, \
-                date)
+            (num_result, success), sent = _request_num_results_scholar( \
+                search_term, date, date, limiter=limiter)
         # PubMed
         elif database == "pubmed":
             # Count the number of search results for this year.
-            num_result, success = get_num_results_pubmed(search_term, date, \
-                field=pubmed_field)
+            (num_result, success), sent = _request_num_results_pubmed( \
+                search_term, date, field=pubmed_field, limiter=limiter)
+        # Local index
+        elif database == "local":
+            # Count the number of search results for this year.
+            num_result, success = get_num_results_local(search_term, date, \
+                local_index, field=pubmed_field)
         
         # Handle any exceptions.
         if not(success):
@@ -213,13 +598,23 @@ def get_yearly_count(search_term, start_date, end_date, database="pubmed", \
         # Add the number to the result dict.
         else:
             result.append(num_result)
+            # Store sub-yearly counts, so that coarser views can be built from
+            # them. Yearly counts aren't stored, so that repeated searches
+            # still get the latest count.
+            if granularity != "year" and fetched:
+                with _period_cache_lock:
+                    if cache_key not in _period_cache.keys():
+                        _period_cache[cache_key] = {}
+                    _period_cache[cache_key][date] = num_result
 
         # Optionally report the search results,
         if verbose:
             print("\t{}: {}".format(date, num_result))
 
         # Sleep to prevent over-asking and consequently being blocked, wait
-        # for a bit until we run the next query.
-        time.sleep(pause)
+        # for a bit until we run the next query. (Not necessary for local,
+        # cached, or shared counts, obviously.)
+        if sent:
+            time.sleep(pause)
         
     return result
@@ -1,8 +1,11 @@
 # Part of bibliobanana, by Edwin Dalmaijer
 # https://github.com/esdalmaijer/bibliobanana
 
+import json
 import os
 
+from .periods import make_period, parse_period
+
 
 def write_results_to_file(file_path, result_dict):
     
@@ -83,9 +86,9 @@ def load_results_from_file(file_path, sep=None):
     for i, line in enumerate(lines):
         # Throw away the trailing newline, and split by separator.
         line = line.replace("\n", "").split(sep)
-        # Grab this line's year.
+        # Grab this line's year (or quarter, or month).
         year = line[term_header.index("year")]
-        result_dict["_year_range"].append(int(year))
+        result_dict["_year_range"].append(make_period(*parse_period(year)))
         # Grab the data for all terms.
         for term_type in ["target", "comparison"]:
             for term in result_dict["_{}".format(term_type)]:
@@ -93,3 +96,258 @@ def load_results_from_file(file_path, sep=None):
     
     return result_dict
         
+
+def _results_matrix(result_dict):
+
+    # Collect all counts in a single (terms x years) matrix. This is the only
+    # copy of the data that is made: data frames and tables are built on top
+    # of (views on) this matrix.
+    import numpy
+    terms = result_dict["_target"] + result_dict["_comparison"]
+    counts = numpy.empty((len(terms), len(result_dict["_year_range"])), \
+        dtype=numpy.int64)
+    for i, term in enumerate(terms):
+        counts[i,:] = result_dict[term]
+    # Years are integers, but quarters and months are strings.
+    if all([type(year) == int for year in result_dict["_year_range"]]):
+        years = numpy.array(result_dict["_year_range"], dtype=numpy.int64)
+    else:
+        years = numpy.array(result_dict["_year_range"], dtype=object)
+
+    return terms, years, counts
+
+
+def _roles(result_dict):
+    return ["target"] * len(result_dict["_target"]) + \
+        ["comparison"] * len(result_dict["_comparison"])
+
+
+def results_to_dataframe(result_dict, layout="wide", study=None):
+
+    """Converts a result_dict into a pandas DataFrame. Requires pandas.
+
+    Arguments
+
+    result_dict     -   dict. Results, as returned by compute_yearly_citations
+                        or load_results_from_file.
+
+    Keyword arguments
+
+    layout          -   str. "wide" for one row per year and one column per
+                        term, or "long" for one row per (term, year) with
+                        columns "term", "role", "year", and "count".
+                        Long data frames from different studies can be
+                        concatenated with pandas.concat. Default = "wide"
+
+    study           -   str. Name of the study. In the long layout, this is
+                        added as a "study" column, so that concatenated
+                        results can be told apart. Default = None
+
+    Returns
+
+    df              -   pandas.DataFrame. The target and comparison terms
+                        are stored in df.attrs["_target"] and
+                        df.attrs["_comparison"].
+    """
+
+    import numpy
+    import pandas
+
+    terms, years, counts = _results_matrix(result_dict)
+
+    if layout == "wide":
+        # The transposed matrix is a view, so the data frame shares memory
+        # with it.
+        df = pandas.DataFrame(counts.T, columns=terms, \
+            index=pandas.Index(years, name="year"), copy=False)
+    elif layout == "long":
+        n_terms, n_years = counts.shape
+        codes = numpy.repeat(numpy.arange(n_terms), n_years)
+        columns = { \
+            "term":pandas.Categorical.from_codes(codes, categories=terms), \
+            "role":pandas.Categorical(numpy.array(_roles(result_dict))[codes], \
+                categories=["target", "comparison"]), \
+            "year":numpy.tile(years, n_terms), \
+            "count":counts.ravel(), \
+            }
+        if study is not None:
+            columns["study"] = pandas.Categorical.from_codes( \
+                numpy.zeros(codes.shape, dtype=numpy.int8), categories=[study])
+        df = pandas.DataFrame(columns, copy=False)
+    else:
+        raise Exception("Unknown layout '{}'; choose 'wide' or 'long'" \
+            .format(layout))
+
+    df.attrs["_target"] = list(result_dict["_target"])
+    df.attrs["_comparison"] = list(result_dict["_comparison"])
+
+    return df
+
+
+def results_from_dataframe(df, study=None):
+
+    """Converts a pandas DataFrame (as created by results_to_dataframe) into
+    a result_dict that can be plotted or passed to write_results_to_file.
+
+    Arguments
+
+    df              -   pandas.DataFrame. Data frame in the wide or long
+                        layout (see results_to_dataframe). The roles of the
+                        terms are taken from df.attrs, or from the "role"
+                        column of long data frames.
+
+    Keyword arguments
+
+    study           -   str. Name of the study to extract from a long data
+                        frame with a "study" column. Required if the data
+                        frame holds more than one study. Default = None
+
+    Returns
+
+    result_dict     -   dict. In the same format as returned by
+                        compute_yearly_citations.
+    """
+
+    result_dict = {}
+
+    # Long layout.
+    if "term" in df.columns and "count" in df.columns:
+        if "study" in df.columns:
+            if study is None:
+                studies = df["study"].unique()
+                if len(studies) > 1:
+                    raise Exception("Data frame holds multiple studies; " + \
+                        "choose one with the study keyword")
+            else:
+                df = df[df["study"] == study]
+        # Find the roles of all terms.
+        if "_target" in df.attrs.keys():
+            result_dict["_target"] = list(df.attrs["_target"])
+            result_dict["_comparison"] = list(df.attrs["_comparison"])
+        elif "role" in df.columns:
+            roles = df.drop_duplicates("term")
+            result_dict["_target"] = \
+                list(roles["term"][roles["role"] == "target"])
+            result_dict["_comparison"] = \
+                list(roles["term"][roles["role"] == "comparison"])
+        else:
+            raise Exception("Could not find term roles in data frame")
+        # Pivot into a (years x terms) table.
+        wide = df.pivot(index="year", columns="term", values="count")
+        result_dict["_year_range"] = wide.index.tolist()
+        for term in result_dict["_target"] + result_dict["_comparison"]:
+            result_dict[term] = wide[term].astype("int64").tolist()
+
+    # Wide layout.
+    else:
+        if "_target" not in df.attrs.keys():
+            raise Exception("Could not find term roles in data frame; " + \
+                "set df.attrs['_target'] and df.attrs['_comparison']")
+        result_dict["_target"] = list(df.attrs["_target"])
+        result_dict["_comparison"] = list(df.attrs["_comparison"])
+        if "year" in df.columns:
+            df = df.set_index("year")
+        result_dict["_year_range"] = df.index.tolist()
+        for term in result_dict["_target"] + result_dict["_comparison"]:
+            result_dict[term] = df[term].tolist()
+
+    return result_dict
+
+
+def results_to_arrow(result_dict, layout="wide", study=None):
+
+    """Converts a result_dict into an Apache Arrow table. Requires pyarrow.
+    The integer columns share memory with a single numpy array, rather than
+    being copied.
+
+    Arguments
+
+    result_dict     -   dict. Results, as returned by compute_yearly_citations
+                        or load_results_from_file.
+
+    Keyword arguments
+
+    layout          -   str. "wide" or "long" (see results_to_dataframe).
+                        Default = "wide"
+
+    study           -   str. Name of the study, added as a "study" column in
+                        the long layout. Default = None
+
+    Returns
+
+    table           -   pyarrow.Table. The target and comparison terms are
+                        stored as JSON in the schema metadata, under the
+                        "bibliobanana" key.
+    """
+
+    import numpy
+    import pyarrow
+
+    terms, years, counts = _results_matrix(result_dict)
+    metadata = {"bibliobanana":json.dumps({ \
+        "_target":list(result_dict["_target"]), \
+        "_comparison":list(result_dict["_comparison"])})}
+
+    if layout == "wide":
+        # Each row of the (C-contiguous) matrix is a contiguous term series,
+        # which Arrow can wrap without copying.
+        arrays = [pyarrow.array(years)]
+        for i in range(len(terms)):
+            arrays.append(pyarrow.array(counts[i,:]))
+        table = pyarrow.Table.from_arrays(arrays, names=["year"] + terms, \
+            metadata=metadata)
+    elif layout == "long":
+        n_terms, n_years = counts.shape
+        codes = numpy.repeat(numpy.arange(n_terms, dtype=numpy.int32), \
+            n_years)
+        roles = numpy.array([0] * len(result_dict["_target"]) + \
+            [1] * len(result_dict["_comparison"]), dtype=numpy.int32)
+        arrays = [ \
+            pyarrow.DictionaryArray.from_arrays(codes, terms), \
+            pyarrow.DictionaryArray.from_arrays(roles[codes], \
+                ["target", "comparison"]), \
+            pyarrow.array(numpy.tile(years, n_terms)), \
+            pyarrow.array(counts.ravel()), \
+            ]
+        names = ["term", "role", "year", "count"]
+        if study is not None:
+            arrays.append(pyarrow.DictionaryArray.from_arrays( \
+                numpy.zeros(codes.shape, dtype=numpy.int32), [study]))
+            names.append("study")
+        table = pyarrow.Table.from_arrays(arrays, names=names, \
+            metadata=metadata)
+    else:
+        raise Exception("Unknown layout '{}'; choose 'wide' or 'long'" \
+            .format(layout))
+
+    return table
+
+
+def results_from_arrow(table, study=None):
+
+    """Converts an Apache Arrow table (as created by results_to_arrow) into a
+    result_dict. See results_from_dataframe for the keyword arguments.
+    """
+
+    # Read the roles from the metadata, if they are there.
+    roles = None
+    if table.schema.metadata is not None and \
+        b"bibliobanana" in table.schema.metadata.keys():
+        roles = json.loads(table.schema.metadata[b"bibliobanana"])
+
+    # Long tables are easiest to handle through pandas.
+    if "term" in table.column_names and "count" in table.column_names:
+        df = table.to_pandas()
+        if roles is not None:
+            df.attrs.update(roles)
+        return results_from_dataframe(df, study=study)
+
+    if roles is None:
+        raise Exception("Could not find term roles in table metadata")
+    result_dict = {"_target":roles["_target"], \
+        "_comparison":roles["_comparison"], \
+        "_year_range":table.column("year").to_pylist()}
+    for term in result_dict["_target"] + result_dict["_comparison"]:
+        result_dict[term] = table.column(term).to_pylist()
+
+    return result_dict
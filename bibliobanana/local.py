@@ -0,0 +1,508 @@
+# Part of bibliobanana, by Edwin Dalmaijer
+# https://github.com/esdalmaijer/bibliobanana
+
+import gzip
+import json
+import multiprocessing
+import os
+import re
+import sqlite3
+import time
+import zlib
+from xml.etree import ElementTree
+
+# The resource module is only available on Unix-like systems. Without it, we
+# simply can't report peak memory use.
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Loaded indices are kept around, so that repeated queries (one per year, per
+# term) don't reload the same file over and over again. Keys are absolute
+# paths, values are (modification time, index) tuples.
+_local_index_cache = {}
+
+# Regular expression that splits text into lower-case word tokens.
+_token_pattern = re.compile(r"[a-z0-9]+")
+
+
+def tokenise(text):
+
+    """Splits a string into a list of lower-case alphanumeric tokens. This is
+    the same tokenisation that is used to build local indices, so query terms
+    should be tokenised with it too.
+    """
+
+    if text is None:
+        return []
+    return _token_pattern.findall(text.lower())
+
+
+def _article_year(article):
+
+    # PubMed's [pdat] is the publication date, which lives in the journal
+    # issue. Most records have a Year element, but some only have a free-text
+    # MedlineDate (e.g. "1998 Dec-1999 Jan"), from which we take the first
+    # four digits.
+    pub_date = article.find("MedlineCitation/Article/Journal/JournalIssue/" \
+        + "PubDate")
+    if pub_date is not None:
+        year = pub_date.findtext("Year")
+        if year is None:
+            year = pub_date.findtext("MedlineDate")
+        if year is not None:
+            match = re.search(r"\d{4}", year)
+            if match is not None:
+                return int(match.group(0))
+    # Fall back to the electronic publication date.
+    year = article.findtext("MedlineCitation/Article/ArticleDate/Year")
+    if year is not None:
+        return int(year)
+
+    return None
+
+
+def iter_pubmed_articles(file_path):
+
+    """Iterates over the PubmedArticle records in a PubMed baseline or update
+    file, without loading the whole file into memory. Each record is cleared
+    from the parse tree after it has been processed, so memory use stays flat
+    regardless of the size of the file.
+
+    Arguments
+
+    file_path       -   str. Path to a PubMed XML file. Files that end in
+                        ".gz" are decompressed on the fly.
+
+    Returns
+
+    generator       -   Yields a dict for each article, with keys "pmid"
+                        (str), "year" (int, or None if no date could be
+                        found), "text" (list of str tokens from the title and
+                        abstract, in order), "mesh" (list of str MeSH
+                        descriptor names), and "majr" (the MeSH descriptor
+                        names that are a major topic of the article). For
+                        each DeleteCitation in an update file, it yields a
+                        dict with the single key "deleted" (list of str
+                        PMIDs) instead.
+    """
+
+    # Open the file, decompressing it if necessary.
+    if os.path.splitext(file_path)[1].lower() == ".gz":
+        f = gzip.open(file_path, "rb")
+    else:
+        f = open(file_path, "rb")
+
+    with f:
+        # Parse the file incrementally. We need the start event for the root
+        # element only, so that we can remove processed articles from it.
+        root = None
+        for event, elem in ElementTree.iterparse(f, events=("start", "end")):
+            if root is None:
+                root = elem
+            if event != "end":
+                continue
+
+            # Process complete articles.
+            if elem.tag == "PubmedArticle":
+                # Collect the text from the title and all abstract sections.
+                # The itertext call is required to include text in nested
+                # markup, such as <i> and <sup>.
+                text = []
+                citation = elem.find("MedlineCitation")
+                title = citation.find("Article/ArticleTitle")
+                if title is not None:
+                    text.extend(tokenise("".join(title.itertext())))
+                for abstract in citation.iterfind( \
+                    "Article/Abstract/AbstractText"):
+                    text.extend(tokenise("".join(abstract.itertext())))
+                # Collect the MeSH descriptor names. Like on PubMed, a
+                # descriptor is a major topic if either it or any of its
+                # qualifiers is marked as major.
+                mesh = []
+                majr = []
+                for heading in citation.iterfind( \
+                    "MeshHeadingList/MeshHeading"):
+                    descriptor = heading.find("DescriptorName")
+                    if descriptor is None or descriptor.text is None:
+                        continue
+                    mesh.append(descriptor.text.lower())
+                    major = [descriptor.get("MajorTopicYN")] + \
+                        [qualifier.get("MajorTopicYN") for qualifier in \
+                        heading.iterfind("QualifierName")]
+                    if "Y" in major:
+                        majr.append(descriptor.text.lower())
+
+                yield {"pmid":citation.findtext("PMID"), \
+                    "year":_article_year(elem), "text":text, "mesh":mesh, \
+                    "majr":majr}
+
+                # Clear the article, and remove it from the root so that the
+                # (now empty) element doesn't linger in memory.
+                elem.clear()
+                root.clear()
+
+            # Deleted citations are listed in update files.
+            elif elem.tag == "DeleteCitation":
+                yield {"deleted":[pmid.text for pmid in \
+                    elem.iterfind("PMID")]}
+                elem.clear()
+                root.clear()
+
+
+# Fields of the count index, besides "total".
+_fields = ["text", "mesh", "majr"]
+
+
+def _count_pubmed_file(file_path):
+
+    # Worker function for the process pool. This counts, for each year, how
+    # many articles contain each token and MeSH term. Each term is counted
+    # once per article, which is what PubMed's count also reflects. It also
+    # returns a compressed record of each article's year and terms, so that
+    # they can be subtracted again when the article is revised or deleted
+    # in a later update file, and the PMIDs that this file deletes.
+    articles = {}
+    deleted = []
+    n_articles = 0
+    for article in iter_pubmed_articles(file_path):
+        if "deleted" in article.keys():
+            for pmid in article["deleted"]:
+                articles.pop(int(pmid), None)
+                deleted.append(int(pmid))
+            continue
+        n_articles += 1
+        # Later versions of the same article (within one file) replace
+        # earlier ones.
+        terms = [sorted(set(article[field])) for field in _fields]
+        articles[int(article["pmid"])] = (article["year"], terms)
+
+    counts = {"total":{}}
+    for field in _fields:
+        counts[field] = {}
+    records = []
+    for pmid, (year, terms) in articles.items():
+        records.append((pmid, year, zlib.compress( \
+            json.dumps(terms).encode("utf-8"))))
+        if year is not None:
+            _add_record(counts, year, terms, 1)
+
+    return file_path, counts, records, deleted, n_articles
+
+
+def _add_record(index, year, terms, sign):
+
+    # Add (sign=1) or subtract (sign=-1) a single article to or from the
+    # counts (in place). Counts that drop to 0 are removed. Year keys are
+    # strings, as they will be stored as JSON anyway.
+    year = str(year)
+    index["total"][year] = index["total"].get(year, 0) + sign
+    if index["total"][year] <= 0:
+        del index["total"][year]
+    for field, field_terms in zip(_fields, terms):
+        for term in field_terms:
+            if term not in index[field]:
+                index[field][term] = {}
+            n = index[field][term].get(year, 0) + sign
+            if n > 0:
+                index[field][term][year] = n
+            else:
+                index[field][term].pop(year, None)
+                if len(index[field][term]) == 0:
+                    del index[field][term]
+
+
+def _merge_counts(index, counts):
+
+    # Add the counts from a single file to the index (in place).
+    for year, n in counts["total"].items():
+        index["total"][year] = index["total"].get(year, 0) + n
+    for field in _fields:
+        for term, yearly in counts[field].items():
+            if term not in index[field]:
+                index[field][term] = yearly
+            else:
+                for year, n in yearly.items():
+                    index[field][term][year] = \
+                        index[field][term].get(year, 0) + n
+
+
+def _records_path(index_path):
+
+    # The record of all ingested PMIDs is stored in an SQLite database next
+    # to the index.
+    return index_path + ".records"
+
+
+def _remove_records(index, db, pmids):
+
+    # Subtract the articles with the given PMIDs from the counts (in place)
+    # and from the record database, if they were ingested before. Returns
+    # the number of articles that were removed.
+    n_removed = 0
+    pmids = list(pmids)
+    # Look up PMIDs in batches, to stay under SQLite's variable limit.
+    for i in range(0, len(pmids), 900):
+        batch = pmids[i:i+900]
+        rows = db.execute("SELECT pmid, year, terms FROM records WHERE " \
+            + "pmid IN ({})".format(",".join(["?"]*len(batch))), \
+            batch).fetchall()
+        for pmid, year, terms in rows:
+            if year is not None:
+                _add_record(index, year, \
+                    json.loads(zlib.decompress(terms).decode("utf-8")), -1)
+        db.executemany("DELETE FROM records WHERE pmid = ?", \
+            [(row[0],) for row in rows])
+        n_removed += len(rows)
+
+    return n_removed
+
+
+def _peak_memory():
+
+    # Returns the peak resident memory in megabytes for this process and for
+    # its (terminated) child processes. On Linux, ru_maxrss is in kilobytes;
+    # on Mac OS X it is in bytes.
+    if resource is None:
+        return None, None
+    if os.uname().sysname == "Darwin":
+        scale = 1024.0 * 1024.0
+    else:
+        scale = 1024.0
+    peak_self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    peak_children = \
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+
+    return peak_self, peak_children
+
+
+def load_local_index(index_path, use_cache=True):
+
+    """Loads a local index that was created with ingest_pubmed_files. Indices
+    are cached, and only reloaded when the file on disk has changed.
+
+    Arguments
+
+    index_path      -   str. Path to the index file.
+
+    Keyword arguments
+
+    use_cache       -   bool. Set to False to always read the index from file,
+                        and not keep it in the cache. Default = True
+
+    Returns
+
+    index           -   dict. With keys "_files" (list of ingested file
+                        names), "total" (dict of yearly article counts),
+                        "text", "mesh", and "majr" (dicts that map each term
+                        onto a dict of yearly article counts). All year keys
+                        are str.
+    """
+
+    index_path = os.path.abspath(index_path)
+    if not os.path.isfile(index_path):
+        raise Exception("Could not find local index at path {}".format( \
+            index_path))
+
+    # Return the cached index if it is still up to date.
+    mtime = os.path.getmtime(index_path)
+    if use_cache and index_path in _local_index_cache.keys():
+        if _local_index_cache[index_path][0] == mtime:
+            return _local_index_cache[index_path][1]
+
+    # Load the index from file.
+    with gzip.open(index_path, "rt", encoding="utf-8") as f:
+        index = json.load(f)
+    if use_cache:
+        _local_index_cache[index_path] = (mtime, index)
+
+    return index
+
+
+def _write_local_index(index_path, data):
+
+    # Write the (gzipped) index to a temporary file first, and then move it
+    # into place. This prevents half-written indices if the process is
+    # killed halfway.
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, index_path)
+
+
+def _save_local_index(index_path, index, db):
+
+    # The counts have to match the records, or revisions would later be
+    # subtracted from counts that never included them (or vice versa). The
+    # index is therefore stored in the record database first, in the same
+    # transaction as the records, and only then written to the index file.
+    # If the process is killed in between, the index file is restored from
+    # the database on the next run (see _restore_local_index).
+    data = gzip.compress(json.dumps(index).encode("utf-8"))
+    db.execute("INSERT OR REPLACE INTO checkpoint VALUES (0, ?, ?)", \
+        (len(index["_files"]), data))
+    db.commit()
+    _write_local_index(index_path, data)
+
+
+def _restore_local_index(index_path, index, db):
+
+    # Returns the index from the last checkpoint in the record database, and
+    # writes it to the index file, if the index file is missing or behind.
+    # Otherwise, index is returned as it is.
+    row = db.execute("SELECT n_files, data FROM checkpoint").fetchone()
+    if row is None or (index is not None and row[0] == len(index["_files"])):
+        return index
+    _write_local_index(index_path, row[1])
+
+    return json.loads(gzip.decompress(row[1]).decode("utf-8"))
+
+
+def ingest_pubmed_files(file_paths, index_path, n_processes=None, \
+    checkpoint_every=50, verbose=False):
+
+    """Builds or updates a local index of yearly counts from PubMed baseline
+    and update files (e.g. from ftp.ncbi.nlm.nih.gov/pubmed/baseline). Files
+    are parsed in a streaming fashion in a pool of worker processes, and their
+    counts are merged into the index as they come in. Files that are already
+    in the index are skipped, so adding the yearly update files only costs
+    the time to parse those.
+
+    Files are applied in the order in which they are passed, so pass update
+    files after the baseline, in the order in which they were released.
+    Revised articles in update files replace their earlier version, and
+    deleted citations are subtracted. To make this possible, the year and
+    terms of every ingested article are stored in an SQLite database next to
+    the index (index_path + ".records"). For the full baseline, this takes
+    up several GB of disk space, but no extra memory. The database also
+    holds a copy of the index from the last checkpoint, so that the counts
+    always match the records, even if a run is interrupted.
+
+    Arguments
+
+    file_paths      -   list. Paths to PubMed XML files (optionally gzipped).
+
+    index_path      -   str. Path to the index file. If it exists, new files
+                        are added to it; otherwise a new index is created.
+
+    Keyword arguments
+
+    n_processes     -   int. Number of worker processes, or None to use as
+                        many as there are CPUs. Each worker only ever holds
+                        one file, and is replaced after it completes, so peak
+                        memory is roughly n_processes times the counts of a
+                        single file. Default = None
+
+    checkpoint_every-   int. Number of files after which the index is written
+                        to disk, so that an interrupted run can be resumed.
+                        Default = 50
+
+    verbose         -   bool. Set to True to see progress printed to the
+                        console. Default = False
+
+    Returns
+
+    stats           -   dict. With keys "n_files" (number of newly ingested
+                        files), "n_articles" (number of newly ingested
+                        articles), "n_replaced" (number of earlier articles
+                        that were revised or deleted), "duration" (seconds),
+                        "articles_per_second", "peak_memory_mb" (of this
+                        process), and "peak_worker_memory_mb" (of the
+                        largest worker). The memory values are None on
+                        systems that don't support reporting them.
+    """
+
+    # Load the existing index, or start a new one. The index is modified in
+    # place, so it shouldn't come from (or end up in) the cache.
+    index = None
+    if os.path.isfile(index_path):
+        index = load_local_index(index_path, use_cache=False)
+        if "majr" not in index.keys() or (len(index["_files"]) > 0 and \
+            not os.path.isfile(_records_path(index_path))):
+            raise Exception("The index at {} was built ".format(index_path) \
+                + "by an older version of bibliobanana, and can't be " \
+                + "updated; please build a new one.")
+    db = sqlite3.connect(_records_path(index_path))
+    db.execute("CREATE TABLE IF NOT EXISTS records (pmid INTEGER PRIMARY " \
+        + "KEY, year INTEGER, terms BLOB)")
+    db.execute("CREATE TABLE IF NOT EXISTS checkpoint (id INTEGER PRIMARY " \
+        + "KEY, n_files INTEGER, data BLOB)")
+    # Pick up where an interrupted run left off.
+    index = _restore_local_index(index_path, index, db)
+    if index is None:
+        index = {"_files":[], "total":{}}
+        for field in _fields:
+            index[field] = {}
+
+    # Only ingest files that aren't in the index yet. Files are identified by
+    # their name, as PubMed file names are unique (e.g. pubmed24n0001.xml.gz).
+    ingested = set(index["_files"])
+    todo = []
+    for file_path in file_paths:
+        name = os.path.basename(file_path)
+        if name not in ingested:
+            todo.append(file_path)
+            ingested.add(name)
+    if verbose:
+        print("Ingesting {} new files ({} already in index)".format( \
+            len(todo), len(file_paths)-len(todo)))
+
+    # Process all files in a pool. Workers are replaced after every file
+    # (maxtasksperchild=1), so memory can't creep up over a long run. Files
+    # are parsed in parallel, but merged in order, so that revisions and
+    # deletions are applied to the right version of each article.
+    t0 = time.time()
+    n_articles = 0
+    n_removed = 0
+    n_files = 0
+    if len(todo) > 0:
+        pool = multiprocessing.Pool(processes=n_processes, \
+            maxtasksperchild=1)
+        try:
+            for file_path, counts, records, deleted, n in \
+                pool.imap(_count_pubmed_file, todo):
+                # Remove earlier versions of revised articles, and deleted
+                # articles. Then merge the counts into the index.
+                n_removed += _remove_records(index, db, \
+                    [record[0] for record in records] + deleted)
+                _merge_counts(index, counts)
+                db.executemany("INSERT INTO records VALUES (?, ?, ?)", \
+                    records)
+                index["_files"].append(os.path.basename(file_path))
+                n_articles += n
+                n_files += 1
+                # Optionally report progress.
+                if verbose:
+                    print("\t{} ({}/{}): {} articles, {:.0f} articles/s" \
+                        .format(os.path.basename(file_path), n_files, \
+                        len(todo), n, n_articles/(time.time()-t0)))
+                # Store intermediate results, together with the records.
+                if n_files % checkpoint_every == 0:
+                    _save_local_index(index_path, index, db)
+        finally:
+            pool.close()
+            pool.join()
+        _save_local_index(index_path, index, db)
+    db.close()
+
+    # Compute the statistics.
+    duration = time.time() - t0
+    if duration > 0:
+        speed = n_articles / duration
+    else:
+        speed = 0.0
+    peak_self, peak_children = _peak_memory()
+    stats = {"n_files":n_files, "n_articles":n_articles, \
+        "n_replaced":n_removed, "duration":duration, \
+        "articles_per_second":speed, "peak_memory_mb":peak_self, \
+        "peak_worker_memory_mb":peak_children}
+    if verbose:
+        print("Ingested {} articles in {:.1f} seconds ".format(n_articles, \
+            duration) + "({:.0f} articles/s)".format( \
+            stats["articles_per_second"]))
+        if peak_self is not None:
+            print("Peak memory: {:.0f} MB (main), {:.0f} MB (worker)".format( \
+                peak_self, peak_children))
+
+    return stats
@@ -0,0 +1,292 @@
+# Part of bibliobanana, by Edwin Dalmaijer
+# https://github.com/esdalmaijer/bibliobanana
+
+import bisect
+import gzip
+import mmap
+import os
+import struct
+from xml.etree import ElementTree
+
+# Every index starts with this, followed by the number of entries (tree
+# numbers) as an unsigned 32-bit int.
+_magic = b"BBMESH1\n"
+_uint_struct = struct.Struct("<I")
+
+# Opened indices, cached by absolute path. Values are (modification time,
+# file, mmap) tuples.
+_mesh_index_cache = {}
+
+
+def _open_text(file_path, mode):
+
+    # Open a file, decompressing it if it ends in ".gz".
+    if os.path.splitext(file_path)[1].lower() == ".gz":
+        return gzip.open(file_path, mode)
+    return open(file_path, mode)
+
+
+def iter_mesh_descriptors(file_path):
+
+    """Iterates over the descriptors in a MeSH descriptor file, as published
+    by the NLM (nlmpubs.nlm.nih.gov/projects/mesh/MESH_FILES). Both the XML
+    (e.g. desc2024.xml) and the ASCII (e.g. d2024.bin) format are supported,
+    optionally gzipped. XML files are parsed in a streaming fashion.
+
+    Arguments
+
+    file_path       -   str. Path to the descriptor file.
+
+    Returns
+
+    generator       -   Yields a (name, tree_numbers) tuple for each
+                        descriptor, where name is a str, and tree_numbers is
+                        a list of str (e.g. ["C04.588.322"]).
+    """
+
+    # Check whether this is an XML file by looking at its first character.
+    with _open_text(file_path, "rb") as f:
+        is_xml = f.read(64).lstrip().startswith(b"<")
+
+    if is_xml:
+        with _open_text(file_path, "rb") as f:
+            root = None
+            for event, elem in ElementTree.iterparse(f, \
+                events=("start", "end")):
+                if root is None:
+                    root = elem
+                if event == "end" and elem.tag == "DescriptorRecord":
+                    name = elem.findtext("DescriptorName/String")
+                    tree_numbers = [t.text for t in \
+                        elem.iterfind("TreeNumberList/TreeNumber")]
+                    yield name, tree_numbers
+                    elem.clear()
+                    root.clear()
+
+    else:
+        # ASCII records start with "*NEWRECORD", and have one "KEY = value"
+        # field per line. MH is the heading, MN a tree number.
+        with _open_text(file_path, "rt") as f:
+            name = None
+            tree_numbers = []
+            for line in f:
+                line = line.rstrip("\n")
+                if line == "*NEWRECORD":
+                    if name is not None:
+                        yield name, tree_numbers
+                    name = None
+                    tree_numbers = []
+                elif line.startswith("MH = "):
+                    name = line[5:]
+                elif line.startswith("MN = "):
+                    tree_numbers.append(line[5:])
+            if name is not None:
+                yield name, tree_numbers
+
+
+def build_mesh_index(descriptor_path, index_path):
+
+    """Creates a compact index of all MeSH tree numbers and their names from
+    a descriptor file. The index is a single binary file that is memory-mapped
+    when it's queried, so it doesn't need to be loaded into memory.
+
+    Arguments
+
+    descriptor_path -   str. Path to a MeSH descriptor file (see
+                        iter_mesh_descriptors).
+
+    index_path      -   str. Path to the index file that is to be created.
+
+    Returns
+
+    n_entries       -   int. The number of tree numbers in the index.
+    """
+
+    # Collect all (tree number, name) pairs, sorted by tree number.
+    entries = []
+    for name, tree_numbers in iter_mesh_descriptors(descriptor_path):
+        for tree_number in tree_numbers:
+            entries.append((tree_number, name))
+    entries.sort()
+
+    # Encode the entries as "tree_number\0name", and keep track of where each
+    # starts in the blob.
+    blob = bytearray()
+    offsets = []
+    for tree_number, name in entries:
+        offsets.append(len(blob))
+        blob += tree_number.encode("utf-8") + b"\0" + name.encode("utf-8")
+    offsets.append(len(blob))
+
+    # Sort the entry numbers by lower-case name, so that names can be looked
+    # up by binary search too.
+    by_name = sorted(range(len(entries)), \
+        key=lambda i: (entries[i][1].lower(), entries[i][0]))
+
+    # Write the header, the offset table, the name table, and the blob.
+    n = len(entries)
+    with open(index_path + ".tmp", "wb") as f:
+        f.write(_magic)
+        f.write(_uint_struct.pack(n))
+        f.write(struct.pack("<{}I".format(n+1), *offsets))
+        f.write(struct.pack("<{}I".format(n), *by_name))
+        f.write(blob)
+    os.replace(index_path + ".tmp", index_path)
+
+    return n
+
+
+def _open_mesh_index(index_path):
+
+    # Return the memory-mapped index, opening (or reopening) it if necessary.
+    index_path = os.path.abspath(index_path)
+    if not os.path.isfile(index_path):
+        raise Exception("Could not find MeSH index at path {}".format( \
+            index_path))
+    mtime = os.path.getmtime(index_path)
+    if index_path in _mesh_index_cache.keys():
+        if _mesh_index_cache[index_path][0] == mtime:
+            return _mesh_index_cache[index_path][2]
+        _mesh_index_cache[index_path][2].close()
+        _mesh_index_cache[index_path][1].close()
+
+    f = open(index_path, "rb")
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if mm[:len(_magic)] != _magic:
+        mm.close()
+        f.close()
+        raise Exception("File at path {} is not a MeSH index".format( \
+            index_path))
+    _mesh_index_cache[index_path] = (mtime, f, mm)
+
+    return mm
+
+
+def _entry_count(mm):
+    return _uint_struct.unpack_from(mm, len(_magic))[0]
+
+
+def _entry(mm, i):
+
+    # Return the (tree number, name) of the i-th entry.
+    n = _entry_count(mm)
+    table = len(_magic) + _uint_struct.size
+    blob = table + (n+1) * _uint_struct.size + n * _uint_struct.size
+    start, end = struct.unpack_from("<2I", mm, table + i*_uint_struct.size)
+    tree_number, name = mm[blob+start:blob+end].decode("utf-8").split("\0")
+
+    return tree_number, name
+
+
+def _entry_by_name(mm, i):
+
+    # Return the entry number of the i-th entry in name order.
+    n = _entry_count(mm)
+    table = len(_magic) + _uint_struct.size + (n+1) * _uint_struct.size
+
+    return _uint_struct.unpack_from(mm, table + i*_uint_struct.size)[0]
+
+
+class _TreeNumbers(object):
+
+    # Sequence view on the sorted tree numbers, for use with bisect.
+    def __init__(self, mm):
+        self.mm = mm
+    def __len__(self):
+        return _entry_count(self.mm)
+    def __getitem__(self, i):
+        return _entry(self.mm, i)[0]
+
+
+class _Names(object):
+
+    # Sequence view on the sorted lower-case names, for use with bisect.
+    def __init__(self, mm):
+        self.mm = mm
+    def __len__(self):
+        return _entry_count(self.mm)
+    def __getitem__(self, i):
+        return _entry(self.mm, _entry_by_name(self.mm, i))[1].lower()
+
+
+def mesh_tree_numbers(index_path, name):
+
+    """Returns the tree numbers (list of str) of a MeSH heading. The lookup is
+    case-insensitive. An empty list is returned for unknown headings.
+    """
+
+    mm = _open_mesh_index(index_path)
+    names = _Names(mm)
+    i = bisect.bisect_left(names, name.lower())
+    tree_numbers = []
+    while i < len(names) and names[i] == name.lower():
+        tree_numbers.append(_entry(mm, _entry_by_name(mm, i))[0])
+        i += 1
+
+    return tree_numbers
+
+
+def mesh_subtree(index_path, root, depth=None, include_root=False):
+
+    """Returns the names of all MeSH headings below a node in the MeSH tree,
+    in a list that can be passed to compute_yearly_citations as search_term
+    or comparison_terms (with pubmed_field="mesh").
+
+    Arguments
+
+    index_path      -   str. Path to an index created with build_mesh_index.
+
+    root            -   str. Tree number (e.g. "C04.588.322", or
+                        "C04.588.322.*") or name (e.g. "Endocrine Gland
+                        Neoplasms") of the node. Names with multiple tree
+                        numbers include the subtrees under all of them.
+
+    Keyword arguments
+
+    depth           -   int. Maximum number of levels below the root to
+                        include, e.g. 1 for only the direct children, or None
+                        for all descendants. Default = None
+
+    include_root    -   bool. Set to True to include the root itself.
+                        Default = False
+
+    Returns
+
+    names           -   list. Unique names of the headings in the subtree
+                        (str), ordered by tree number.
+    """
+
+    mm = _open_mesh_index(index_path)
+    tree_numbers = _TreeNumbers(mm)
+
+    # Find the tree number(s) of the root.
+    if root.endswith(".*"):
+        root = root[:-2]
+    roots = mesh_tree_numbers(index_path, root)
+    if len(roots) == 0:
+        roots = [root]
+
+    names = []
+    seen = set()
+    for root in roots:
+        # All descendants directly follow the root in the sorted list, as
+        # their tree numbers start with the root's.
+        root_depth = root.count(".")
+        i = bisect.bisect_left(tree_numbers, root)
+        while i < len(tree_numbers):
+            tree_number, name = _entry(mm, i)
+            if tree_number == root:
+                include = include_root
+            elif tree_number.startswith(root + "."):
+                include = (depth is None) or \
+                    (tree_number.count(".") - root_depth <= depth)
+            elif not tree_number.startswith(root):
+                break
+            else:
+                include = False
+            if include and name not in seen:
+                names.append(name)
+                seen.add(name)
+            i += 1
+
+    return names
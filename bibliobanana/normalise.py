@@ -0,0 +1,195 @@
+# Part of bibliobanana, by Edwin Dalmaijer
+# https://github.com/esdalmaijer/bibliobanana
+
+import json
+import os
+import threading
+import time
+
+from .get import database_name, get_yearly_count, TOTAL
+from .periods import parse_period, period_range
+
+# Counts of reference series (comparison terms, or all records), by a JSON
+# string of [database, field, term, period]. Values are [count, timestamp]
+# lists, where the timestamp is the time at which the count was fetched.
+# These are shared by all studies in this process, and stored on disk so
+# that they are shared between sessions too.
+_denominator_cache = {}
+_denominator_cache_lock = threading.Lock()
+_denominator_cache_loaded = False
+_denominator_cache_file = os.path.join(os.path.expanduser("~"), \
+    ".bibliobanana", "denominators.json")
+
+# Counts of older years hardly change, but recent years are still being
+# indexed. Counts for periods in the last two years are thus refreshed after
+# a day, and all others after 90 days.
+_max_age_recent = 24 * 3600.0
+_max_age = 90 * 24 * 3600.0
+
+
+def set_denominator_cache_file(file_path):
+
+    """Sets the file in which reference series are stored between sessions,
+    or disables storing them on disk if file_path is None. The default is
+    ~/.bibliobanana/denominators.json
+    """
+
+    global _denominator_cache_file, _denominator_cache_loaded
+    with _denominator_cache_lock:
+        _denominator_cache_file = file_path
+        _denominator_cache_loaded = False
+
+
+def clear_denominator_cache(from_disk=False):
+
+    """Forgets all cached reference series in this process, and optionally
+    also deletes the cache file.
+    """
+
+    with _denominator_cache_lock:
+        _denominator_cache.clear()
+        if from_disk and _denominator_cache_file is not None and \
+            os.path.isfile(_denominator_cache_file):
+            os.remove(_denominator_cache_file)
+
+
+def _load_cache_file():
+
+    # Merge the cache file into the in-memory cache, keeping the most recent
+    # count for each key. Should be called while holding the lock.
+    global _denominator_cache_loaded
+    _denominator_cache_loaded = True
+    if _denominator_cache_file is None or \
+        not os.path.isfile(_denominator_cache_file):
+        return
+    try:
+        with open(_denominator_cache_file, "r") as f:
+            stored = json.load(f)
+    except ValueError:
+        # A corrupt cache simply means counts will be fetched again.
+        return
+    for key, value in stored.items():
+        if key not in _denominator_cache.keys() or \
+            value[1] > _denominator_cache[key][1]:
+            _denominator_cache[key] = value
+
+
+def _save_cache_file():
+
+    # Write the cache to disk. Other processes might have added counts in the
+    # meantime, so those are merged in first. Should be called while holding
+    # the lock.
+    if _denominator_cache_file is None:
+        return
+    _load_cache_file()
+    cache_dir = os.path.dirname(os.path.abspath(_denominator_cache_file))
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    tmp_path = "{}.{}.tmp".format(_denominator_cache_file, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(_denominator_cache, f)
+    os.replace(tmp_path, _denominator_cache_file)
+
+
+def _is_fresh(period, timestamp, now):
+
+    # Check whether a cached count is recent enough to be used.
+    year = parse_period(period)[1]
+    if year >= time.localtime(now).tm_year - 1:
+        return now - timestamp < _max_age_recent
+    return now - timestamp < _max_age
+
+
+def get_denominator_series(term, start_date, end_date, database="pubmed", \
+    exact_phrase=True, pubmed_field="word", granularity="year", pause=1.0, \
+    verbose=False, local_index=None, limiter=None, refresh=False):
+
+    """Returns the counts for a reference series, such as a comparison term or
+    the total number of records, from start_date until end_date. Counts are
+    cached in this process and on disk (see set_denominator_cache_file), so
+    that each period is only requested once, regardless of how many studies
+    normalise against it.
+
+    Arguments
+
+    term            -   str. The reference term, or bibliobanana.get.TOTAL
+                        ("_total") for the total number of records.
+
+    start_date      -   int or str. First year or period (inclusive).
+
+    end_date        -   int or str. Last year or period (inclusive).
+
+    Keyword arguments
+
+    database, exact_phrase, pubmed_field, granularity, pause, verbose,
+    local_index, limiter
+                    -   See get_yearly_count.
+
+    refresh         -   bool. Set to True to fetch all periods anew, even if
+                        they are cached, and to update the cache with them.
+                        Default = False
+
+    Returns
+
+    result          -   list. The count for each period from start_date until
+                        end_date (see bibliobanana.periods.period_range).
+    """
+
+    # Local counts cost nothing, and change whenever files are added to the
+    # index, so they aren't cached.
+    if database_name(database) == "local":
+        return get_yearly_count(term, start_date, end_date, \
+            database=database, exact_phrase=exact_phrase, \
+            pubmed_field=pubmed_field, pause=pause, verbose=verbose, \
+            local_index=local_index, granularity=granularity, \
+            limiter=limiter)
+
+    periods = period_range(start_date, end_date, granularity)
+    # Quoted and unquoted terms give different counts, so they are cached
+    # separately.
+    if term != TOTAL and exact_phrase:
+        cache_term = "\"{}\"".format(term)
+    else:
+        cache_term = term
+    # The field doesn't matter when counting all records.
+    if term == TOTAL:
+        cache_field = None
+    else:
+        cache_field = pubmed_field
+    keys = [json.dumps([database_name(database), cache_field, cache_term, \
+        period]) for period in periods]
+
+    # Find the periods that aren't cached yet (or whose counts are stale).
+    now = time.time()
+    with _denominator_cache_lock:
+        if not _denominator_cache_loaded:
+            _load_cache_file()
+        missing = []
+        for period, key in zip(periods, keys):
+            if refresh or key not in _denominator_cache.keys() or \
+                not _is_fresh(period, _denominator_cache[key][1], now):
+                missing.append(period)
+
+    # Fetch the missing periods.
+    if len(missing) > 0:
+        if verbose:
+            print("Fetching {} of {} periods for reference '{}'".format( \
+                len(missing), len(periods), term))
+        fetched = {}
+        for period in missing:
+            fetched[period] = get_yearly_count(term, period, period, \
+                database=database, exact_phrase=exact_phrase, \
+                pubmed_field=pubmed_field, pause=pause, verbose=verbose, \
+                local_index=local_index, granularity=granularity, \
+                limiter=limiter)[0]
+        now = time.time()
+        with _denominator_cache_lock:
+            for period, key in zip(periods, keys):
+                if period in fetched.keys():
+                    _denominator_cache[key] = [fetched[period], now]
+            _save_cache_file()
+
+    with _denominator_cache_lock:
+        result = [_denominator_cache[key][0] for key in keys]
+
+    return result
@@ -0,0 +1,221 @@
+# Part of bibliobanana, by Edwin Dalmaijer
+# https://github.com/esdalmaijer/bibliobanana
+
+# Time periods are represented as follows:
+#   years       -   int, e.g. 2020
+#   quarters    -   str, e.g. "2020-Q1"
+#   months      -   str, e.g. "2020-03"
+# Years are kept as plain integers, so that yearly results look exactly like
+# they always have.
+
+import re
+
+_quarter_pattern = re.compile(r"^(-?\d+)-Q([1-4])$")
+_month_pattern = re.compile(r"^(-?\d+)-(\d{2})$")
+
+_granularities = ["year", "quarter", "month"]
+
+
+def parse_period(period):
+
+    """Splits a period into its granularity, year, and number within the year.
+
+    Arguments
+
+    period          -   int or str. A year (e.g. 2020 or "2020"), quarter
+                        (e.g. "2020-Q1"), or month (e.g. "2020-03").
+
+    Returns
+
+    granularity, year, number   -   [str, int, int]. The granularity is one
+                        of "year", "quarter", or "month". The number is the
+                        quarter (1-4) or month (1-12), or None for years.
+    """
+
+    if type(period) == int:
+        return "year", period, None
+    period = str(period)
+    if re.match(r"^-?\d+$", period):
+        return "year", int(period), None
+    match = _quarter_pattern.match(period)
+    if match is not None:
+        return "quarter", int(match.group(1)), int(match.group(2))
+    match = _month_pattern.match(period)
+    if match is not None and 1 <= int(match.group(2)) <= 12:
+        return "month", int(match.group(1)), int(match.group(2))
+
+    raise Exception("Could not parse time period '{}'".format(period))
+
+
+def make_period(granularity, year, number=None):
+
+    """Returns the period label for a year, and optionally a quarter or month.
+    """
+
+    if granularity == "year":
+        return int(year)
+    elif granularity == "quarter":
+        return "{}-Q{}".format(year, number)
+    elif granularity == "month":
+        return "{}-{:02d}".format(year, number)
+
+    raise Exception("Unknown granularity '{}'; choose from {}".format( \
+        granularity, _granularities))
+
+
+def period_range(start, end, granularity="year"):
+
+    """Returns a list of all periods from start until end (inclusive).
+
+    Arguments
+
+    start           -   int or str. First year, or first period of the
+                        chosen granularity (e.g. "2020-03" for months).
+
+    end             -   int or str. Last year, or last period of the chosen
+                        granularity. Years include all of their quarters or
+                        months.
+
+    Keyword arguments
+
+    granularity     -   str. "year", "quarter", or "month". Default = "year"
+
+    Returns
+
+    periods         -   list. Period labels (see parse_period).
+    """
+
+    if granularity not in _granularities:
+        raise Exception("Unknown granularity '{}'; choose from {}".format( \
+            granularity, _granularities))
+    n_per_year = {"year":1, "quarter":4, "month":12}[granularity]
+
+    # Convert the start and end to an ordinal number of periods.
+    ordinals = []
+    for i, period in enumerate([start, end]):
+        g, year, number = parse_period(period)
+        if g == "year":
+            if granularity == "year":
+                number = 1
+            elif i == 0:
+                number = 1
+            else:
+                number = n_per_year
+        elif g != granularity:
+            raise Exception("Period '{}' does not match granularity '{}'" \
+                .format(period, granularity))
+        ordinals.append(year * n_per_year + number - 1)
+
+    periods = []
+    for ordinal in range(ordinals[0], ordinals[1] + 1):
+        periods.append(make_period(granularity, ordinal // n_per_year, \
+            ordinal % n_per_year + 1))
+
+    return periods
+
+
+def period_children(period):
+
+    """Returns the periods that a period consists of, one level down: the
+    quarters of a year, or the months of a quarter. Returns None for months.
+    """
+
+    granularity, year, number = parse_period(period)
+    if granularity == "year":
+        return [make_period("quarter", year, q) for q in range(1, 5)]
+    elif granularity == "quarter":
+        return [make_period("month", year, 3*(number-1)+m) \
+            for m in range(1, 4)]
+
+    return None
+
+
+def period_parent(period, granularity):
+
+    """Returns the period of a coarser granularity that contains a period,
+    e.g. "2020-Q1" for "2020-03" with granularity "quarter".
+    """
+
+    g, year, number = parse_period(period)
+    if _granularities.index(granularity) > _granularities.index(g):
+        raise Exception("Cannot convert '{}' into a finer granularity" \
+            .format(period))
+    if granularity == "year":
+        return year
+    elif granularity == g:
+        return period
+    # The only option left is a month within a quarter.
+    return make_period("quarter", year, (number - 1) // 3 + 1)
+
+
+def period_granularity(periods):
+
+    """Returns the granularity of a list of periods, which all need to be of
+    the same granularity.
+    """
+
+    granularities = set([parse_period(period)[0] for period in periods])
+    if len(granularities) > 1:
+        raise Exception("Periods have mixed granularities: {}".format( \
+            sorted(granularities)))
+    if len(granularities) == 0:
+        return "year"
+
+    return granularities.pop()
+
+
+def period_to_float(period):
+
+    """Returns the start of a period as a (fractional) year, e.g. 2020.25 for
+    "2020-Q2", for plotting on a numerical time axis.
+    """
+
+    granularity, year, number = parse_period(period)
+    if granularity == "quarter":
+        return year + (number - 1) / 4.0
+    elif granularity == "month":
+        return year + (number - 1) / 12.0
+
+    return year
+
+
+def aggregate_results(result_dict, granularity="year"):
+
+    """Sums the counts in a result_dict into a coarser granularity, e.g. from
+    months into quarters or years. No new requests are made.
+
+    Arguments
+
+    result_dict     -   dict. Results, as returned by compute_yearly_citations
+                        or load_results_from_file.
+
+    Keyword arguments
+
+    granularity     -   str. "year", "quarter", or "month". Default = "year"
+
+    Returns
+
+    result_dict     -   dict. A new result_dict, with the summed counts. Note
+                        that periods at the edges only include the counts
+                        within the original range.
+    """
+
+    aggregated = {"_target":list(result_dict["_target"]), \
+        "_comparison":list(result_dict["_comparison"]), "_year_range":[]}
+    if "_query" in result_dict.keys():
+        aggregated["_query"] = dict(result_dict["_query"])
+    # Find which new period each of the original periods ends up in.
+    parents = [period_parent(period, granularity) for period in \
+        result_dict["_year_range"]]
+    for parent in parents:
+        if parent not in aggregated["_year_range"]:
+            aggregated["_year_range"].append(parent)
+    # Sum the counts.
+    for term in aggregated["_target"] + aggregated["_comparison"]:
+        counts = dict([(parent, 0) for parent in aggregated["_year_range"]])
+        for parent, count in zip(parents, result_dict[term]):
+            counts[parent] += count
+        aggregated[term] = [counts[parent] for parent in \
+            aggregated["_year_range"]]
+
+    return aggregated
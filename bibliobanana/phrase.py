@@ -0,0 +1,702 @@
+# Part of bibliobanana, by Edwin Dalmaijer
+# https://github.com/esdalmaijer/bibliobanana
+
+from array import array
+import bisect
+import mmap
+import multiprocessing
+import os
+import sqlite3
+import struct
+import time
+
+from .encoding import encode_varints, decode_varints, delta_encode, \
+    delta_decode
+from .local import iter_pubmed_articles, tokenise, _peak_memory
+
+# Loaded indices are cached by their absolute directory path. Values are
+# (database modification time, index) tuples.
+_phrase_index_cache = {}
+# Query results are cached by (directory, database modification time,
+# tokens, exact_phrase), as get_yearly_count asks for one year at a time.
+_phrase_count_cache = {}
+
+# Name of the SQLite database that lists which PubMed files are in an index
+# (in the order in which they were added), where the current version of
+# each article lives, and which documents have been replaced by a later
+# version or deleted.
+_database_name = "index.sqlite"
+# Name of the file that listed the PubMed files in older indices.
+_manifest_name = "manifest.json"
+
+# Every segment starts with this, followed by the number of documents and
+# the number of tokens as unsigned 32-bit ints. Then follow the year of each
+# document (unsigned 16-bit), the offsets of the sorted tokens in the token
+# blob, the document frequency of each token, the offsets of each token's
+# postings list in the postings blob (all unsigned 32-bit), the token blob,
+# and the postings blob.
+_magic = b"BBPHRS1\n"
+_header_struct = struct.Struct("<2I")
+
+
+def _build_segment(args):
+
+    # Worker function for the process pool. This creates a positional index
+    # for a single PubMed file, and writes it to disk as a segment. Documents
+    # are numbered from 0 within each segment. For every token, the postings
+    # list is a single varint stream that holds, per document: the gap from
+    # the previous document number, the number of positions, and the gaps
+    # between positions. Besides the number of articles, it returns the
+    # PMIDs of all articles in the file, the PMID of each document, and the
+    # PMIDs that the file deletes, so that earlier versions of these
+    # articles can be marked as deleted.
+    file_path, segment_path = args
+    articles = {}
+    deleted = []
+    n_articles = 0
+    for article in iter_pubmed_articles(file_path):
+        if "deleted" in article.keys():
+            for pmid in article["deleted"]:
+                articles.pop(int(pmid), None)
+                deleted.append(int(pmid))
+            continue
+        n_articles += 1
+        # Later versions of the same article (within one file) replace
+        # earlier ones.
+        articles[int(article["pmid"])] = (article["year"], article["text"])
+
+    years = array("H")
+    doc_pmids = []
+    postings = {}
+    doc_freq = {}
+    last_doc = {}
+    doc_id = 0
+    for pmid, (year, text) in articles.items():
+        # Articles without a year can't be counted, so leave them out.
+        if year is None:
+            continue
+        years.append(year)
+        doc_pmids.append(pmid)
+        # Find the positions of all tokens in this article.
+        positions = {}
+        for pos, token in enumerate(text):
+            if token not in positions:
+                positions[token] = []
+            positions[token].append(pos)
+        # Add this article to the postings lists.
+        for token, pos_list in positions.items():
+            if token not in postings:
+                postings[token] = bytearray()
+                doc_freq[token] = 0
+                last_doc[token] = 0
+            postings[token] += encode_varints( \
+                [doc_id - last_doc[token], len(pos_list)] \
+                + delta_encode(pos_list))
+            doc_freq[token] += 1
+            last_doc[token] = doc_id
+        doc_id += 1
+
+    # Store the segment, with the tokens in sorted order so that they can be
+    # looked up by binary search.
+    tokens = sorted(postings.keys())
+    token_blob = bytearray()
+    token_offsets = []
+    postings_offsets = []
+    n_bytes = 0
+    for token in tokens:
+        token_offsets.append(len(token_blob))
+        token_blob += token.encode("utf-8")
+        postings_offsets.append(n_bytes)
+        n_bytes += len(postings[token])
+    token_offsets.append(len(token_blob))
+    postings_offsets.append(n_bytes)
+    n = len(tokens)
+    with open(segment_path + ".tmp", "wb") as f:
+        f.write(_magic)
+        f.write(_header_struct.pack(len(years), n))
+        f.write(struct.pack("<{}H".format(len(years)), *years))
+        f.write(struct.pack("<{}I".format(n+1), *token_offsets))
+        f.write(struct.pack("<{}I".format(n), \
+            *[doc_freq[token] for token in tokens]))
+        f.write(struct.pack("<{}I".format(n+1), *postings_offsets))
+        f.write(token_blob)
+        for token in tokens:
+            f.write(postings[token])
+    os.replace(segment_path + ".tmp", segment_path)
+
+    return file_path, n_articles, list(articles.keys()), doc_pmids, deleted
+
+
+class _Segment(object):
+
+    """Read-only, memory-mapped view on a segment file. Only the parts of
+    the file that are queried are read (and cached by the operating system),
+    so even a full baseline index doesn't have to fit in memory.
+    """
+
+    def __init__(self, segment_path):
+        # The memory map keeps its own duplicate of the file descriptor, so
+        # the file can be closed straight away. This halves the number of
+        # open files, as a full index (baseline and updates) has more than
+        # a thousand segments, and many systems allow only 1024 open files.
+        with open(segment_path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(_magic)] != _magic:
+            self.close()
+            raise Exception("File at path {} is not a phrase index ".format( \
+                segment_path) + "segment, or it was built by an older " \
+                + "version of bibliobanana; please rebuild the index.")
+        self.n_docs, self.n_tokens = _header_struct.unpack_from(self.mm, \
+            len(_magic))
+        # Start of each section of the file.
+        self._years = len(_magic) + _header_struct.size
+        self._token_offsets = self._years + 2 * self.n_docs
+        self._doc_freqs = self._token_offsets + 4 * (self.n_tokens + 1)
+        self._postings_offsets = self._doc_freqs + 4 * self.n_tokens
+        self._token_blob = self._postings_offsets + 4 * (self.n_tokens + 1)
+        self._postings_blob = self._token_blob + struct.unpack_from("<I", \
+            self.mm, self._token_offsets + 4 * self.n_tokens)[0]
+
+    def close(self):
+        self.mm.close()
+
+    def years(self):
+        # Returns the year of every document.
+        return struct.unpack_from("<{}H".format(self.n_docs), self.mm, \
+            self._years)
+
+    def year(self, doc):
+        return struct.unpack_from("<H", self.mm, self._years + 2*doc)[0]
+
+    def __len__(self):
+        return self.n_tokens
+
+    def __getitem__(self, i):
+        # The i-th token (as bytes), so that the segment can be bisected.
+        start, end = struct.unpack_from("<2I", self.mm, \
+            self._token_offsets + 4*i)
+        return self.mm[self._token_blob+start:self._token_blob+end]
+
+    def postings(self, token):
+        # Returns the (document frequency, postings list) of a token, or None
+        # if the token doesn't occur in this segment.
+        key = token.encode("utf-8")
+        i = bisect.bisect_left(self, key)
+        if i == self.n_tokens or self[i] != key:
+            return None
+        doc_freq = struct.unpack_from("<I", self.mm, self._doc_freqs + 4*i)[0]
+        start, end = struct.unpack_from("<2I", self.mm, \
+            self._postings_offsets + 4*i)
+        return doc_freq, \
+            self.mm[self._postings_blob+start:self._postings_blob+end]
+
+
+def _decode_postings(data):
+
+    # Decode a postings list into a list of document numbers, and a parallel
+    # list of position lists.
+    docs = []
+    positions = []
+    doc = 0
+    offset = 0
+    while offset < len(data):
+        header, offset = decode_varints(data, offset, count=2)
+        doc += header[0]
+        deltas, offset = decode_varints(data, offset, count=header[1])
+        docs.append(doc)
+        positions.append(delta_decode(deltas))
+
+    return docs, positions
+
+
+def _intersect_sorted(a, b):
+
+    # Intersect two sorted lists of unique integers. When one list is much
+    # shorter than the other, binary searching (galloping) through the long
+    # list is faster than walking through both.
+    if len(a) > len(b):
+        a, b = b, a
+    result = []
+    if len(a) * 8 < len(b):
+        lo = 0
+        for value in a:
+            lo = bisect.bisect_left(b, value, lo)
+            if lo == len(b):
+                break
+            if b[lo] == value:
+                result.append(value)
+    else:
+        i = 0
+        j = 0
+        while i < len(a) and j < len(b):
+            if a[i] == b[j]:
+                result.append(a[i])
+                i += 1
+                j += 1
+            elif a[i] < b[j]:
+                i += 1
+            else:
+                j += 1
+
+    return result
+
+
+def _count_segment(segment, tokens, exact_phrase, deleted):
+
+    # Count the documents in a single segment that contain all tokens (and,
+    # optionally, contain them as an exact phrase). Documents in the deleted
+    # set were replaced by a later version, or deleted, and don't count.
+    counts = {}
+    unique = list(set(tokens))
+    postings = {}
+    for token in unique:
+        postings[token] = segment.postings(token)
+        if postings[token] is None:
+            return counts
+    # Start with the rarest token, as this keeps the intersection short.
+    unique.sort(key=lambda token: postings[token][0])
+    decoded = {}
+    docs = None
+    for token in unique:
+        decoded[token] = _decode_postings(postings[token][1])
+        if docs is None:
+            docs = decoded[token][0]
+        else:
+            docs = _intersect_sorted(docs, decoded[token][0])
+        if len(docs) == 0:
+            return counts
+    if len(deleted) > 0:
+        docs = [doc for doc in docs if doc not in deleted]
+
+    # Check whether the tokens occur in the right order.
+    if exact_phrase and len(tokens) > 1:
+        lookup = {}
+        for token in unique:
+            lookup[token] = dict(zip(decoded[token][0], decoded[token][1]))
+        matches = []
+        for doc in docs:
+            following = [set(lookup[token][doc]) for token in tokens[1:]]
+            for pos in lookup[tokens[0]][doc]:
+                found = True
+                for i, positions in enumerate(following):
+                    if pos + i + 1 not in positions:
+                        found = False
+                        break
+                if found:
+                    matches.append(doc)
+                    break
+        docs = matches
+
+    # Count the matching documents per year.
+    for doc in docs:
+        year = str(segment.year(doc))
+        counts[year] = counts.get(year, 0) + 1
+
+    return counts
+
+
+def _check_version(index_dir):
+
+    # Indices from older versions listed their files in a manifest, and
+    # didn't keep track of revised and deleted articles.
+    if os.path.isfile(os.path.join(index_dir, _manifest_name)):
+        raise Exception("The phrase index in {} was built by an ".format( \
+            index_dir) + "older version of bibliobanana, and doesn't " \
+            + "handle revised and deleted articles; please build a new one.")
+
+
+def _open_database(index_dir):
+
+    # Open (or create) the index database.
+    db = sqlite3.connect(os.path.join(index_dir, _database_name))
+    db.execute("CREATE TABLE IF NOT EXISTS files (segment INTEGER PRIMARY " \
+        + "KEY, name TEXT)")
+    db.execute("CREATE TABLE IF NOT EXISTS live (pmid INTEGER PRIMARY KEY, " \
+        + "segment INTEGER, doc INTEGER)")
+    db.execute("CREATE TABLE IF NOT EXISTS deleted (segment INTEGER, " \
+        + "doc INTEGER)")
+
+    return db
+
+
+def _replace_articles(db, pmids):
+
+    # Mark the current documents of the given PMIDs (if there are any) as
+    # deleted. Returns the number of documents that were marked.
+    n_replaced = 0
+    pmids = list(pmids)
+    # Look up PMIDs in batches, to stay under SQLite's variable limit.
+    for i in range(0, len(pmids), 900):
+        batch = pmids[i:i+900]
+        rows = db.execute("SELECT pmid, segment, doc FROM live WHERE pmid " \
+            + "IN ({})".format(",".join(["?"]*len(batch))), batch).fetchall()
+        db.executemany("INSERT INTO deleted VALUES (?, ?)", \
+            [(row[1], row[2]) for row in rows])
+        db.executemany("DELETE FROM live WHERE pmid = ?", \
+            [(row[0],) for row in rows])
+        n_replaced += len(rows)
+
+    return n_replaced
+
+
+def load_phrase_index(index_dir):
+
+    """Opens a positional index that was created with build_phrase_index.
+    Segments are memory-mapped rather than read into memory, so memory use
+    depends on the postings lists that are queried rather than on the size
+    of the index. Indices are cached, and only segments that were added since
+    the last call are opened.
+
+    Arguments
+
+    index_dir       -   str. Path to the index directory.
+
+    Returns
+
+    index           -   dict. With keys "_files" (list of ingested file
+                        names), "segments" (list of memory-mapped segments,
+                        one per ingested file), and "deleted" (list with a
+                        set for each segment, of the documents that were
+                        replaced by a later version, or deleted).
+    """
+
+    index_dir = os.path.abspath(index_dir)
+    _check_version(index_dir)
+    database_path = os.path.join(index_dir, _database_name)
+    if not os.path.isfile(database_path):
+        raise Exception("Could not find phrase index in directory {}" \
+            .format(index_dir))
+
+    # Return the cached index if it is still up to date. Otherwise, reuse
+    # the segments that are already open.
+    mtime = os.path.getmtime(database_path)
+    opened = {}
+    if index_dir in _phrase_index_cache.keys():
+        if _phrase_index_cache[index_dir][0] == mtime:
+            return _phrase_index_cache[index_dir][1]
+        cached = _phrase_index_cache[index_dir][1]
+        opened = dict(zip(cached["_files"], cached["segments"]))
+
+    # Read the list of files, and the deleted documents.
+    db = sqlite3.connect(database_path)
+    try:
+        names = [row[0] for row in db.execute("SELECT name FROM files " \
+            + "ORDER BY segment")]
+        deleted = [set() for name in names]
+        for segment, doc in db.execute("SELECT segment, doc FROM deleted"):
+            deleted[segment].add(doc)
+    finally:
+        db.close()
+
+    # Open all new segments.
+    index = {"_files":names, "segments":[], "deleted":deleted}
+    for name in names:
+        if name in opened.keys():
+            index["segments"].append(opened[name])
+        else:
+            index["segments"].append(_Segment(os.path.join(index_dir, \
+                name + ".seg")))
+    _phrase_index_cache[index_dir] = (mtime, index)
+
+    return index
+
+
+def build_phrase_index(file_paths, index_dir, n_processes=None, \
+    verbose=False):
+
+    """Builds or updates a positional index of the titles and abstracts in
+    PubMed baseline and update files. Unlike the count index created by
+    bibliobanana.local.ingest_pubmed_files, this can count exact phrases
+    (e.g. "prefrontal cortex"), at the cost of a larger index. Each file
+    becomes a separate segment in the index directory, so files that are
+    already in the index are skipped.
+
+    Files are added in the order in which they are passed, so pass update
+    files after the baseline, in the order in which they were released.
+    Revised articles in update files replace their earlier version, and
+    deleted citations are removed. Where the current version of each article
+    lives is stored in an SQLite database in the index directory.
+
+    Arguments
+
+    file_paths      -   list. Paths to PubMed XML files (optionally gzipped).
+
+    index_dir       -   str. Path to the index directory. It will be created
+                        if it doesn't exist yet.
+
+    Keyword arguments
+
+    n_processes     -   int. Number of worker processes, or None to use as
+                        many as there are CPUs. Default = None
+
+    verbose         -   bool. Set to True to see progress printed to the
+                        console. Default = False
+
+    Returns
+
+    stats           -   dict. With keys "n_files", "n_articles",
+                        "n_replaced", "duration", "articles_per_second",
+                        "peak_worker_memory_mb" (see ingest_pubmed_files),
+                        and "index_size_bytes".
+    """
+
+    # Open the existing index, or start a new one.
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+    _check_version(index_dir)
+    db = _open_database(index_dir)
+    files = [row[0] for row in db.execute("SELECT name FROM files ORDER BY " \
+        + "segment")]
+
+    # Only process files that aren't in the index yet.
+    ingested = set(files)
+    todo = []
+    for file_path in file_paths:
+        name = os.path.basename(file_path)
+        if name not in ingested:
+            todo.append((file_path, os.path.join(index_dir, name + ".seg")))
+            ingested.add(name)
+    if verbose:
+        print("Indexing {} new files ({} already in index)".format( \
+            len(todo), len(file_paths)-len(todo)))
+
+    # Build the segments in a pool. Workers write their own segment, so that
+    # the main process never holds the postings. Segments are built in
+    # parallel, but added in order, so that revisions and deletions are
+    # applied to the right version of each article. Each file is committed
+    # to the database in a single transaction, so an interrupted run can
+    # simply be resumed.
+    t0 = time.time()
+    n_articles = 0
+    n_replaced = 0
+    n_files = 0
+    if len(todo) > 0:
+        pool = multiprocessing.Pool(processes=n_processes, \
+            maxtasksperchild=1)
+        try:
+            for file_path, n, pmids, doc_pmids, deleted in \
+                pool.imap(_build_segment, todo):
+                segment = len(files)
+                n_replaced += _replace_articles(db, pmids + deleted)
+                db.executemany("INSERT INTO live VALUES (?, ?, ?)", \
+                    [(pmid, segment, doc) for doc, pmid in \
+                    enumerate(doc_pmids)])
+                db.execute("INSERT INTO files VALUES (?, ?)", (segment, \
+                    os.path.basename(file_path)))
+                db.commit()
+                files.append(os.path.basename(file_path))
+                n_articles += n
+                n_files += 1
+                if verbose:
+                    print("\t{} ({}/{}): {} articles".format( \
+                        os.path.basename(file_path), n_files, len(todo), n))
+        finally:
+            pool.close()
+            pool.join()
+    db.close()
+
+    # Compute the statistics.
+    duration = time.time() - t0
+    if duration > 0:
+        speed = n_articles / duration
+    else:
+        speed = 0.0
+    peak_self, peak_children = _peak_memory()
+    stats = {"n_files":n_files, "n_articles":n_articles, \
+        "n_replaced":n_replaced, "duration":duration, \
+        "articles_per_second":speed, \
+        "peak_worker_memory_mb":peak_children, \
+        "index_size_bytes":phrase_index_size(index_dir)}
+    if verbose:
+        print("Indexed {} articles in {:.1f} seconds ".format(n_articles, \
+            duration) + "({:.0f} articles/s), index size {:.1f} MB".format( \
+            speed, stats["index_size_bytes"]/(1024.0*1024.0)))
+
+    return stats
+
+
+def phrase_index_size(index_dir):
+
+    """Returns the total size (in bytes) of all files in an index directory.
+    """
+
+    size = 0
+    for name in os.listdir(index_dir):
+        size += os.path.getsize(os.path.join(index_dir, name))
+
+    return size
+
+
+def count_phrase(index_dir, phrase, exact_phrase=True, use_cache=True):
+
+    """Counts the number of articles per year in a positional index that
+    contain a phrase.
+
+    Arguments
+
+    index_dir       -   str. Path to the index directory.
+
+    phrase          -   str. The phrase to count. It is tokenised in the same
+                        way as the indexed text, so case and punctuation
+                        don't matter.
+
+    Keyword arguments
+
+    exact_phrase    -   bool. Set to True to only count articles in which the
+                        words of the phrase occur consecutively and in order,
+                        or to False to count articles that contain all words
+                        anywhere. Default = True
+
+    use_cache       -   bool. Set to False to force the query to be run,
+                        even if its result is known. Default = True
+
+    Returns
+
+    counts          -   dict. Maps years (str) onto the number of articles.
+                        Years without any matches are not included.
+    """
+
+    tokens = tokenise(phrase)
+    if len(tokens) == 0:
+        raise Exception("Phrase '{}' does not contain any words".format( \
+            phrase))
+
+    # Return a cached result, if there is one.
+    index_dir = os.path.abspath(index_dir)
+    index = load_phrase_index(index_dir)
+    key = (index_dir, _phrase_index_cache[index_dir][0], tuple(tokens), \
+        exact_phrase)
+    if use_cache and key in _phrase_count_cache.keys():
+        return _phrase_count_cache[key]
+
+    # Sum the counts over all segments.
+    counts = {}
+    for segment, deleted in zip(index["segments"], index["deleted"]):
+        for year, n in _count_segment(segment, tokens, exact_phrase, \
+            deleted).items():
+            counts[year] = counts.get(year, 0) + n
+    _phrase_count_cache[key] = counts
+
+    return counts
+
+
+def count_articles(index_dir):
+
+    """Returns the total number of articles per year in a positional index,
+    as a dict that maps years (str) onto counts.
+    """
+
+    index_dir = os.path.abspath(index_dir)
+    index = load_phrase_index(index_dir)
+    key = (index_dir, _phrase_index_cache[index_dir][0], None, None)
+    if key in _phrase_count_cache.keys():
+        return _phrase_count_cache[key]
+
+    counts = {}
+    for segment, deleted in zip(index["segments"], index["deleted"]):
+        for doc, year in enumerate(segment.years()):
+            if doc not in deleted:
+                counts[str(year)] = counts.get(str(year), 0) + 1
+    _phrase_count_cache[key] = counts
+
+    return counts
+
+
+def count_phrase_brute_force(file_paths, phrase, exact_phrase=True):
+
+    """Counts the number of articles per year that contain a phrase, by
+    scanning through every article in PubMed XML files. Like in
+    build_phrase_index, revised articles replace their earlier version, and
+    deleted citations are removed. This is very slow, and is intended for
+    checking the results of count_phrase.
+
+    Arguments
+
+    file_paths      -   list. Paths to PubMed XML files (optionally gzipped).
+
+    phrase          -   str. The phrase to count.
+
+    Keyword arguments
+
+    exact_phrase    -   bool. See count_phrase. Default = True
+
+    Returns
+
+    counts          -   dict. Maps years (str) onto the number of articles.
+    """
+
+    # Keep track of whether the current version of each article matches.
+    tokens = tokenise(phrase)
+    n = len(tokens)
+    matches = {}
+    for file_path in file_paths:
+        for article in iter_pubmed_articles(file_path):
+            if "deleted" in article.keys():
+                for pmid in article["deleted"]:
+                    matches.pop(pmid, None)
+                continue
+            matches.pop(article["pmid"], None)
+            if article["year"] is None:
+                continue
+            text = article["text"]
+            if exact_phrase:
+                found = False
+                for i in range(len(text) - n + 1):
+                    if text[i:i+n] == tokens:
+                        found = True
+                        break
+            else:
+                found = set(tokens).issubset(set(text))
+            if found:
+                matches[article["pmid"]] = str(article["year"])
+
+    # Count the matches per year.
+    counts = {}
+    for year in matches.values():
+        counts[year] = counts.get(year, 0) + 1
+
+    return counts
+
+
+def benchmark_phrase_index(index_dir, phrases, exact_phrase=True, \
+    n_repeats=10):
+
+    """Measures how long it takes to count phrases in a positional index.
+    Results are not taken from the cache, so each repeat runs the full query.
+
+    Arguments
+
+    index_dir       -   str. Path to the index directory.
+
+    phrases         -   list. Phrases (str) to count.
+
+    Keyword arguments
+
+    exact_phrase    -   bool. See count_phrase. Default = True
+
+    n_repeats       -   int. Number of times each query is run. Default = 10
+
+    Returns
+
+    result          -   dict. With keys "index_size_bytes" (int),
+                        "n_segments" (int), and "latency" (dict that maps
+                        each phrase onto a dict with the "min", "median", and
+                        "max" query time in seconds).
+    """
+
+    # Load the index before timing, so that loading isn't counted.
+    index = load_phrase_index(index_dir)
+    result = {"index_size_bytes":phrase_index_size(index_dir), \
+        "n_segments":len(index["segments"]), "latency":{}}
+    for phrase in phrases:
+        times = []
+        for i in range(n_repeats):
+            t0 = time.perf_counter()
+            count_phrase(index_dir, phrase, exact_phrase=exact_phrase, \
+                use_cache=False)
+            times.append(time.perf_counter() - t0)
+        times.sort()
+        result["latency"][phrase] = {"min":times[0], \
+            "median":times[len(times)//2], "max":times[-1]}
+
+    return result
@@ -4,6 +4,10 @@
 import numpy
 from matplotlib import pyplot
 
+from .get import TOTAL
+from .normalise import get_denominator_series
+from .periods import period_granularity, period_to_float
+
 # Colours are from the Tango Desktop Project's palette.
 # In order of appearance: blue, green, purple, red, orange, brown
 # Yellow is used as the comparison colour.
@@ -12,9 +16,19 @@ _colour_for_comparison = "#c4a000"
 
 def plot_yearly_count(result_dict, plot_ratio=False, \
     plot_average_comparison=True, scale_to_max=False, \
-    ax=None, figsize=(8.0,6.0), dpi=100.0):
+    ax=None, figsize=(8.0,6.0), dpi=100.0, normalise_by=None):
     
     """Plots the results from a result_dict.
+
+    When plot_ratio is True, target terms are divided by the average of the
+    comparison terms, or by normalise_by if it is passed. This can be a list
+    of counts (one per period), the name of a term in result_dict, or the
+    name of a reference series (e.g. bibliobanana.get.TOTAL for all
+    records). Reference series are fetched through the shared cache in
+    bibliobanana.normalise (which might require a request), from the same
+    database and field, and with the same exact_phrase setting, as the
+    results; compute_yearly_citations records these under "_query".
+    normalise_by is ignored when plot_ratio is False.
     """
     
     # Create a new figure.
@@ -26,6 +40,15 @@ def plot_yearly_count(result_dict, plot_ratio=False, \
     # We'll be keeping track of the maximum result (to scale the y axis), so
     # we start at 0. (It will be updated as we go along.)
     max_result = 0
+
+    # Convert the time periods to (fractional) years, so that quarters and
+    # months are plotted within their year. For yearly results, this is just
+    # the range of years. The step is the width of a single period.
+    x = numpy.array([period_to_float(p) for p in result_dict["_year_range"]])
+    step = {"year":1.0, "quarter":0.25, "month":1.0/12.0}[ \
+        period_granularity(result_dict["_year_range"])]
+    # Ticks are placed on the start of all years in the range.
+    tick_years = list(range(int(numpy.floor(x[0])), int(numpy.floor(x[-1]))+1))
     
     # If there are more than one comparison terms, compute their average.
     if len(result_dict["_comparison"]) > 1:
@@ -57,6 +80,35 @@ def plot_yearly_count(result_dict, plot_ratio=False, \
             m /= numpy.max(m)
         ci = None
 
+    # Replace the comparison by a different denominator if requested. This
+    # only makes sense for ratios; otherwise, the comparison line would be
+    # labelled as something it isn't.
+    if plot_ratio and normalise_by is not None:
+        if type(normalise_by) == str and normalise_by in result_dict.keys():
+            m = numpy.array(result_dict[normalise_by], dtype=numpy.float64)
+        elif type(normalise_by) == str:
+            # The reference needs to be counted in the same way as the
+            # results, or the ratio is meaningless.
+            if "_query" not in result_dict.keys():
+                raise Exception("Cannot fetch reference series " \
+                    + "'{}', because the results don't ".format( \
+                    normalise_by) + "record how they were fetched; pass " \
+                    + "its counts as normalise_by instead.")
+            query = result_dict["_query"]
+            m = numpy.array(get_denominator_series(normalise_by, \
+                result_dict["_year_range"][0], result_dict["_year_range"][-1], \
+                database=query["database"], \
+                pubmed_field=query["pubmed_field"], \
+                exact_phrase=query["exact_phrase"], \
+                local_index=query.get("local_index", None), \
+                granularity=period_granularity(result_dict["_year_range"])), \
+                dtype=numpy.float64)
+        else:
+            m = numpy.array(normalise_by, dtype=numpy.float64)
+        if scale_to_max and numpy.max(m) > 0:
+            m /= numpy.max(m)
+        ci = None
+
     # Plot the results together if the user opted for this.
     if plot_average_comparison and not plot_ratio:
         # Choose the label for the line.
@@ -65,11 +117,10 @@ def plot_yearly_count(result_dict, plot_ratio=False, \
         else:
             lbl = result_dict["_comparison"][0]
         # Plot the average and confidence intervals.
-        ax.plot(result_dict["_year_range"], m, "-", lw=2, \
-            color=_colour_for_comparison, label=lbl)
+        ax.plot(x, m, "-", lw=2, color=_colour_for_comparison, label=lbl)
         highest = numpy.max(m)
         if ci is not None:
-            ax.fill_between(result_dict["_year_range"], m, m-ci, m+ci, \
+            ax.fill_between(x, m-ci, m+ci, \
                 color=_colour_for_comparison, alpha=0.3)
             highest = numpy.max(m+ci)
         # Check if this term's maximum is higher than the mean plus the
@@ -83,8 +134,8 @@ def plot_yearly_count(result_dict, plot_ratio=False, \
             y = numpy.array(result_dict[term], dtype=numpy.float64)
             if scale_to_max and numpy.max(y) > 0:
                 y /= numpy.max(y)
-            ax.plot(result_dict["_year_range"], y, "-", lw=2, \
-                color=_colour_for_comparison, label=term)
+            ax.plot(x, y, "-", lw=2, color=_colour_for_comparison, \
+                label=term)
         # Check if this term's maximum is higher than the current.
         if numpy.max(y) > max_result:
             max_result = numpy.max(y)
@@ -107,63 +158,69 @@ def plot_yearly_count(result_dict, plot_ratio=False, \
             # expected behaviour here could perhaps be to set the keyword
             # ratio to infinite, but given the futility of such a comparison,
             # perhaps NaN or 0 are better options.
-            y[m==0] = numpy.NaN
+            y[m==0] = numpy.nan
         # Plot the line for the result.
-        ax.plot(result_dict["_year_range"], y, "-", lw=2, color=col, \
-            label=term)
+        ax.plot(x, y, "-", lw=2, color=col, label=term)
         # Check if this term's maximum is higher than the current.
         if numpy.nanmax(y) > max_result:
             max_result = numpy.nanmax(y)
         
     # If we have more than 10 years, only write ticks on the even years.
-    if 30 >= len(result_dict["_year_range"]) > 10:
+    if 30 >= len(tick_years) > 10:
         # The starting index (si) should be 0 if the first year is even, and
         # 1 if the first year is odd.
-        si = result_dict["_year_range"][0] % 2
+        si = tick_years[0] % 2
         # Create a list of indices to slice only the even years.
-        xi = range(si, len(result_dict["_year_range"]), 2)
+        xi = range(si, len(tick_years), 2)
         # Create empty tick labels for all recorded years. (Note: This will
         # only work for years -999 to 9999; just up the number in "|U4" if
         # you're somehow still using this in the future, or want to include
         # references earlier than 999 BC.
-        xticklabels = numpy.zeros(len(result_dict["_year_range"]), dtype="|U4")
+        xticklabels = numpy.zeros(len(tick_years), dtype="|U4")
         xticklabels[xticklabels=="0"] = ""
         # Set only the recorded year tick labels.
-        xticklabels[xi] = numpy.array(result_dict["_year_range"])[xi]
+        xticklabels[xi] = numpy.array(tick_years)[xi]
     # If we have more than 30 years, only write ticks every 5 years.
-    elif len(result_dict["_year_range"]) > 30:
+    elif len(tick_years) > 30:
         # Find the lowest year that is divisible by 5.
         si = None
-        for i in range(len(result_dict["_year_range"])):
-            if result_dict["_year_range"][i] % 5 == 0:
+        for i in range(len(tick_years)):
+            if tick_years[i] % 5 == 0:
                 si = i
                 break
         # Create a list of indices to slice only the %5 years.
-        xi = range(si, len(result_dict["_year_range"]), 5)
+        xi = range(si, len(tick_years), 5)
         # Create empty tick labels for all recorded years. (Note: This will
         # only work for years -999 to 9999; just up the number in "|U4" if
         # you're somehow still using this in the future, or want to include
         # references earlier than 999 BC.
-        xticklabels = numpy.zeros(len(result_dict["_year_range"]), dtype="|U4")
+        xticklabels = numpy.zeros(len(tick_years), dtype="|U4")
         xticklabels[xticklabels=="0"] = ""
         # Set only the recorded year tick labels.
-        xticklabels[xi] = numpy.array(result_dict["_year_range"])[xi]
+        xticklabels[xi] = numpy.array(tick_years)[xi]
     # If we have 10 years or fewer, simply use all as tick labels.
     else:
-        xticklabels = map(str, result_dict["_year_range"])
+        xticklabels = map(str, tick_years)
     # Set the x ticks (for all recorded years) and x tick labels (created
     # above; either for all years or only for even years.)
-    ax.set_xticks(result_dict["_year_range"])
+    ax.set_xticks(tick_years)
     ax.set_xticklabels(map(str, xticklabels), fontsize=16, rotation=85)
-    # Set the axis limits. For the x-axis, this is the first year minus 1,
-    # and the last year plus one. For the y-axis, this is 0 to the maximum
+    # Set the axis limits. For the x-axis, this is the first period minus 1,
+    # and the last period plus one. For the y-axis, this is 0 to the maximum
     # number of search results plus a small margin.
-    ax.set_xlim([result_dict["_year_range"][0]-1, \
-        result_dict["_year_range"][-1]+1])
+    ax.set_xlim([min(x[0]-step, tick_years[0]), x[-1]+step])
     ax.set_ylim([0, max_result*1.05])
     # Set the y label.
     if plot_ratio:
-        if (len(result_dict["_comparison"]) == 1) and \
+        if normalise_by is not None:
+            if type(normalise_by) == str and normalise_by == TOTAL:
+                ylbl = "Proportion of all publications"
+            else:
+                ylbl = "Relative publication ratio"
+        elif (len(result_dict["_comparison"]) == 1) and \
+        (result_dict["_comparison"][0] == TOTAL):
+            ylbl = "Proportion of all publications"
+        elif (len(result_dict["_comparison"]) == 1) and \
         (result_dict["_comparison"][0] in ["banana","\"banana\"","\'banana\'"]):
             ylbl = "Banana ratio"
         else:
@@ -0,0 +1,358 @@
+# Part of bibliobanana, by Edwin Dalmaijer
+# https://github.com/esdalmaijer/bibliobanana
+
+import threading
+import time
+
+from .get import database_name, get_yearly_count
+from .normalise import get_denominator_series
+from .periods import period_range
+
+
+def _refinement_levels(n, coarse_step):
+
+    # Splits the indices 0..n-1 into levels of refinement: first every
+    # coarse_step-th index (and the last one, so that there is nothing to
+    # extrapolate), then the indices halfway between those, and so on until
+    # all indices are included.
+    levels = []
+    seen = set()
+    step = max(1, coarse_step)
+    first = True
+    while True:
+        level = list(range(0, n, step))
+        if first and n > 0 and n - 1 not in level:
+            level.append(n - 1)
+        first = False
+        level = [i for i in level if i not in seen]
+        seen.update(level)
+        if len(level) > 0:
+            levels.append(level)
+        if step == 1:
+            break
+        step = max(1, step // 2)
+
+    return levels
+
+
+def _interpolate(values):
+
+    # Fill in the None values in a list by linear interpolation between the
+    # nearest known neighbours, or by the nearest known value at the edges.
+    # Returns None if no values are known at all.
+    known = [i for i, v in enumerate(values) if v is not None]
+    if len(known) == 0:
+        return None
+    filled = list(values)
+    for i in range(len(values)):
+        if filled[i] is not None:
+            continue
+        before = [k for k in known if k < i]
+        after = [k for k in known if k > i]
+        if len(before) == 0:
+            filled[i] = values[after[0]]
+        elif len(after) == 0:
+            filled[i] = values[before[-1]]
+        else:
+            a = before[-1]
+            b = after[0]
+            filled[i] = int(round(values[a] + (values[b] - values[a]) \
+                * float(i - a) / float(b - a)))
+
+    return filled
+
+
+class _RequestCounter(object):
+
+    # Counts the requests that are actually sent. This is passed to
+    # get_yearly_count as its limiter, which is only waited for before a
+    # request goes out, and not for cached or local counts.
+
+    def __init__(self):
+        self.n = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            self.n += 1
+
+
+class ProgressiveFetch(object):
+
+    """Fetches counts in order of importance rather than in order of time, so
+    that a rough trend is available long before all counts are in. Counts are
+    fetched for a coarse sample of periods first (targets before comparisons),
+    after which the gaps are refined. Use run to fetch within a budget,
+    result to get the counts so far (with the gaps interpolated), and
+    start_background to fetch the rest in a background thread. The number of
+    requests that were actually sent (i.e. not counting cached or local
+    counts) is kept in n_requests.
+
+    Arguments
+
+    search_term     -   str or list. The target term(s).
+
+    start_date      -   int or str. First year or period (inclusive).
+
+    end_date        -   int or str. Last year or period (inclusive).
+
+    Keyword arguments
+
+    comparison_terms-   str or list. The comparison term(s). These are
+                        fetched through the shared cache in
+                        bibliobanana.normalise. Default = "banana"
+
+    coarse_step     -   int. Distance between periods in the first, coarse
+                        sample. Default = 5
+
+    database, exact_phrase, pubmed_field, granularity, pause, local_index
+                    -   See get_yearly_count.
+    """
+
+    def __init__(self, search_term, start_date, end_date, \
+        comparison_terms="banana", coarse_step=5, database="pubmed", \
+        exact_phrase=True, pubmed_field="text", granularity="year", \
+        pause=1.0, local_index=None):
+
+        # Wrap the search and comparison terms in a list.
+        if type(search_term) not in [tuple, list]:
+            search_term = [search_term]
+        if type(comparison_terms) not in [tuple, list]:
+            comparison_terms = [comparison_terms]
+        self.search_term = list(search_term)
+        self.comparison_terms = list(comparison_terms)
+        self.periods = period_range(start_date, end_date, granularity)
+        self.pause = pause
+        self._kwargs = {"database":database, "exact_phrase":exact_phrase, \
+            "pubmed_field":pubmed_field, "granularity":granularity, \
+            "local_index":local_index}
+
+        # Queue all tasks in order of priority. Within each level of
+        # refinement, all target terms come before the comparison terms.
+        self._tasks = []
+        for level in _refinement_levels(len(self.periods), coarse_step):
+            for term in self.search_term:
+                for i in level:
+                    self._tasks.append((term, i, False))
+            for term in self.comparison_terms:
+                for i in level:
+                    self._tasks.append((term, i, True))
+
+        # Fetched counts, by term and then by period index.
+        self._counts = {}
+        for term in self.search_term + self.comparison_terms:
+            self._counts[term] = [None] * len(self.periods)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._requests = _RequestCounter()
+        self.error = None
+
+    @property
+    def done(self):
+        """True when all counts have been fetched."""
+        with self._lock:
+            return len(self._tasks) == 0
+
+    @property
+    def n_requests(self):
+        """Number of requests that were sent, excluding cached and local
+        counts."""
+        return self._requests.n
+
+    def _missing_terms(self):
+
+        # Returns the terms that don't have a single fetched count yet.
+        with self._lock:
+            return [term for term, values in self._counts.items() \
+                if all([v is None for v in values])]
+
+    def _fetch_next(self, terms=None):
+
+        # Fetch the next task in line, or the next task for one of terms if
+        # they are passed. Returns False if there was none.
+        with self._lock:
+            index = None
+            for j, task in enumerate(self._tasks):
+                if terms is None or task[0] in terms:
+                    index = j
+                    break
+            if index is None:
+                return False
+            term, i, is_comparison = self._tasks.pop(index)
+        period = self.periods[i]
+        try:
+            if is_comparison:
+                num = get_denominator_series(term, period, period, \
+                    pause=0.0, limiter=self._requests, **self._kwargs)[0]
+            else:
+                num = get_yearly_count(term, period, period, pause=0.0, \
+                    limiter=self._requests, **self._kwargs)[0]
+        except Exception:
+            # Put the task back, so that the next run tries it again.
+            with self._lock:
+                self._tasks.insert(index, (term, i, is_comparison))
+            raise
+        with self._lock:
+            self._counts[term][i] = num
+
+        return True
+
+    def run(self, time_budget=None, request_budget=None):
+
+        """Fetches counts until all are in, or until a budget runs out. Only
+        requests that are actually sent count towards the budgets, and are
+        followed by a pause; cached and local counts are free. When a budget
+        runs out before every term has at least one fetched count, fetching
+        continues (for those terms only) until they do, so that the result
+        can always be written to file and plotted.
+
+        Keyword arguments
+
+        time_budget     -   float. Maximum number of seconds to spend, or
+                            None for no limit. The request that is running
+                            when time runs out is completed. Default = None
+
+        request_budget  -   int. Maximum number of requests to send, or None
+                            for no limit. Default = None
+
+        Returns
+
+        result_dict     -   dict. See result.
+        """
+
+        t0 = time.time()
+        n0 = self.n_requests
+        while not self._stop.is_set():
+            missing = self._missing_terms()
+            over_budget = (request_budget is not None and \
+                self.n_requests - n0 >= request_budget) or \
+                (time_budget is not None and time.time() - t0 >= time_budget)
+            if over_budget and len(missing) == 0:
+                break
+            n = self.n_requests
+            if over_budget:
+                fetched = self._fetch_next(missing)
+            else:
+                fetched = self._fetch_next()
+            if not fetched:
+                break
+            if self.n_requests == n:
+                continue
+            # Sleep to stay under the rate limit, but not past the deadline
+            # (unless there are still terms without counts, in which case
+            # more requests will follow).
+            pause = self.pause
+            if time_budget is not None and len(self._missing_terms()) == 0:
+                pause = min(pause, max(0.0, time_budget-(time.time()-t0)))
+            time.sleep(pause)
+
+        return self.result()
+
+    def _run_background(self):
+        try:
+            self.run()
+        except Exception as e:
+            self.error = e
+
+    def start_background(self):
+
+        """Fetches the remaining counts in a background thread. Check done,
+        or call wait, to find out when it has finished. If a request fails,
+        the thread stops, and the exception is stored in error.
+        """
+
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run_background)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def wait(self, timeout=None):
+
+        """Waits for the background thread to finish, for at most timeout
+        seconds (or indefinitely if timeout is None). Returns the result.
+        """
+
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+        return self.result()
+
+    def cancel(self):
+
+        """Stops the background thread after its current request."""
+
+        self._stop.set()
+
+    def result(self):
+
+        """Returns the counts so far as a result_dict, in the same format as
+        compute_yearly_citations. Counts that haven't been fetched yet are
+        interpolated from the nearest fetched periods. Terms without any
+        fetched counts are None, which only happens when result is called
+        before run has returned, or after it was cancelled or failed; such
+        results can't be written to file or plotted. The "_fetched" key maps
+        each term onto a list of bools that is True for fetched counts, and
+        False for estimated ones.
+        """
+
+        with self._lock:
+            counts = dict([(term, list(values)) for term, values in \
+                self._counts.items()])
+        result_dict = {"_target":list(self.search_term), \
+            "_comparison":list(self.comparison_terms), \
+            "_year_range":list(self.periods), "_fetched":{}, \
+            "_query":{"database":database_name(self._kwargs["database"]), \
+            "pubmed_field":self._kwargs["pubmed_field"], \
+            "exact_phrase":self._kwargs["exact_phrase"], \
+            "local_index":self._kwargs["local_index"]}}
+        for term in self.search_term + self.comparison_terms:
+            result_dict["_fetched"][term] = [v is not None for v in \
+                counts[term]]
+            result_dict[term] = _interpolate(counts[term])
+
+        return result_dict
+
+
+def progressive_yearly_citations(search_term, start_date, end_date, \
+    comparison_terms="banana", time_budget=10.0, request_budget=None, \
+    continue_in_background=True, coarse_step=5, database="pubmed", \
+    exact_phrase=True, pubmed_field="text", granularity="year", pause=1.0, \
+    local_index=None):
+
+    """Returns a rough result within a time or request budget (which is
+    exceeded only as far as needed to get at least one count for each term),
+    and optionally keeps refining it in the background. See ProgressiveFetch
+    for the order in which counts are fetched, and for the keyword arguments
+    that aren't listed here.
+
+    Keyword arguments
+
+    time_budget     -   float. Seconds to spend before returning, or None
+                        for no limit. Default = 10.0
+
+    request_budget  -   int. Number of requests to send before returning,
+                        or None for no limit. Default = None
+
+    continue_in_background  -   bool. Set to True to keep fetching the
+                        remaining counts after returning. Default = True
+
+    Returns
+
+    result_dict, fetcher    -   [dict, ProgressiveFetch]. The result so far
+                        (see ProgressiveFetch.result), and the object that
+                        can be used to get updated results later on.
+    """
+
+    fetcher = ProgressiveFetch(search_term, start_date, end_date, \
+        comparison_terms=comparison_terms, coarse_step=coarse_step, \
+        database=database, exact_phrase=exact_phrase, \
+        pubmed_field=pubmed_field, granularity=granularity, pause=pause, \
+        local_index=local_index)
+    result_dict = fetcher.run(time_budget=time_budget, \
+        request_budget=request_budget)
+    if continue_in_background and not fetcher.done:
+        fetcher.start_background()
+
+    return result_dict, fetcher
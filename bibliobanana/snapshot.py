@@ -0,0 +1,476 @@
+# Part of bibliobanana, by Edwin Dalmaijer
+# https://github.com/esdalmaijer/bibliobanana
+
+import bisect
+import datetime
+import json
+import mmap
+import os
+import struct
+import time
+
+from .encoding import encode_varints, decode_varints, delta_encode, \
+    delta_decode, zigzag_encode, zigzag_decode
+from .get import database_name
+from .periods import make_period, parse_period, period_granularity, \
+    period_range
+
+# Every store starts with this, so that we don't accidentally read (or worse,
+# append to) a different kind of file.
+_magic = b"BBSNAP2\n"
+# Each record starts with its payload length (unsigned 32-bit int), followed
+# by its timestamp (64-bit float).
+_length_struct = struct.Struct("<I")
+_timestamp_struct = struct.Struct("<d")
+# Record kinds. Keyframes hold complete counts (delta-encoded over periods);
+# delta records hold the change from the term's previous snapshot.
+_keyframe = 0
+_delta = 1
+# Number of snapshots after which a term gets a new keyframe. This bounds the
+# number of records that need decoding to reconstruct a single snapshot.
+_keyframe_interval = 32
+
+# Default query settings, for results that don't record how they were
+# fetched. These are the defaults of compute_yearly_citations.
+_default_query = {"database":"pubmed", "pubmed_field":"text", \
+    "exact_phrase":True}
+
+# Record offsets per series, cached by absolute path. As stores are append-
+# only, we only need to scan the part of the file that was added since the
+# last time it was read.
+_store_index_cache = {}
+
+
+def _to_timestamp(value):
+
+    # Convert datetimes, dates, and numbers to a Unix timestamp.
+    if value is None:
+        return time.time()
+    elif isinstance(value, datetime.datetime):
+        return value.timestamp()
+    elif isinstance(value, datetime.date):
+        return datetime.datetime(value.year, value.month, value.day) \
+            .timestamp()
+    return float(value)
+
+
+def _query_settings(result_dict=None, database=None, pubmed_field=None, \
+    exact_phrase=None):
+
+    # Returns the database, field, and exact_phrase setting of a series.
+    # Explicit values come first, then those that the result_dict recorded
+    # (see compute_yearly_citations), and then the defaults.
+    query = dict(_default_query)
+    if result_dict is not None and "_query" in result_dict.keys():
+        query.update(result_dict["_query"])
+    for key, value in [("database", database), \
+        ("pubmed_field", pubmed_field), ("exact_phrase", exact_phrase)]:
+        if value is not None:
+            query[key] = value
+
+    return database_name(query["database"]), query["pubmed_field"], \
+        bool(query["exact_phrase"])
+
+
+def _series_key(term, database, pubmed_field, exact_phrase, granularity):
+
+    # Records are stored by series rather than by term, as counts of the same
+    # term from different databases, fields, with and without quotes, or per
+    # year and per month are different histories.
+    return json.dumps([database, pubmed_field, exact_phrase, granularity, \
+        term])
+
+
+def _period_ordinal(period):
+
+    # Number periods consecutively, so that a range of periods can be stored
+    # as its first number and its length.
+    granularity, year, number = parse_period(period)
+    if granularity == "quarter":
+        return 4 * year + number - 1
+    elif granularity == "month":
+        return 12 * year + number - 1
+    return year
+
+
+def _ordinal_period(ordinal, granularity):
+
+    # Inverse of _period_ordinal.
+    if granularity == "quarter":
+        return make_period(granularity, ordinal // 4, ordinal % 4 + 1)
+    elif granularity == "month":
+        return make_period(granularity, ordinal // 12, ordinal % 12 + 1)
+    return ordinal
+
+
+def _read_store_index(store_path):
+
+    # Returns the cached record index for a store, after scanning any records
+    # that were appended since the last call. The index maps each series key
+    # (see _series_key) onto three parallel lists: timestamps, record
+    # offsets, and record kinds.
+    store_path = os.path.abspath(store_path)
+    if not os.path.isfile(store_path):
+        raise Exception("Could not find snapshot store at path {}".format( \
+            store_path))
+    if store_path not in _store_index_cache.keys():
+        _store_index_cache[store_path] = {"size":len(_magic), "series":{}}
+    index = _store_index_cache[store_path]
+
+    size = os.path.getsize(store_path)
+    if size < index["size"]:
+        # The file shrunk, so it was replaced. Start over.
+        index["size"] = len(_magic)
+        index["series"] = {}
+    if size == index["size"]:
+        return index
+
+    with open(store_path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if mm[:len(_magic)] != _magic:
+                raise Exception("File at path {} is not a snapshot store" \
+                    .format(store_path) + ", or was created by an older " \
+                    + "version of bibliobanana")
+            offset = index["size"]
+            while offset + _length_struct.size <= size:
+                length = _length_struct.unpack_from(mm, offset)[0]
+                start = offset + _length_struct.size
+                # Stop at incomplete records (e.g. from a crashed write).
+                if start + length > size:
+                    break
+                timestamp = _timestamp_struct.unpack_from(mm, start)[0]
+                (n,), pos = decode_varints(mm, start+_timestamp_struct.size, \
+                    count=1)
+                key = mm[pos:pos+n].decode("utf-8")
+                kind = mm[pos+n]
+                if key not in index["series"]:
+                    index["series"][key] = ([], [], [])
+                index["series"][key][0].append(timestamp)
+                index["series"][key][1].append(offset)
+                index["series"][key][2].append(kind)
+                offset = start + length
+            index["size"] = offset
+        finally:
+            mm.close()
+
+    return index
+
+
+def _decode_record(mm, offset, granularity):
+
+    # Decode a single record's kind, period range, and (delta) counts.
+    start = offset + _length_struct.size + _timestamp_struct.size
+    (n,), pos = decode_varints(mm, start, count=1)
+    kind = mm[pos+n]
+    (start, n_periods), pos = decode_varints(mm, pos+n+1, count=2)
+    values, pos = decode_varints(mm, pos, count=n_periods)
+    values = [zigzag_decode(v) for v in values]
+    if kind == _keyframe:
+        values = delta_decode(values)
+    year_range = [_ordinal_period(i, granularity) for i in \
+        range(zigzag_decode(start), zigzag_decode(start)+n_periods)]
+
+    return kind, year_range, values
+
+
+def _reconstruct(mm, entry, i, granularity):
+
+    # Reconstruct the counts of a series' i-th snapshot, by decoding from the
+    # closest preceding keyframe onwards.
+    timestamps, offsets, kinds = entry
+    k = i
+    while kinds[k] != _keyframe:
+        k -= 1
+    year_range, counts = None, None
+    for j in range(k, i+1):
+        kind, year_range, values = _decode_record(mm, offsets[j], \
+            granularity)
+        if kind == _keyframe:
+            counts = values
+        else:
+            counts = [c + v for c, v in zip(counts, values)]
+
+    return year_range, counts
+
+
+def _snapshot_at(store_path, keys, as_of):
+
+    # Returns a dict that maps each series key onto the (year_range, counts)
+    # of its latest snapshot at or before as_of, or None if there is no such
+    # snapshot.
+    index = _read_store_index(store_path)
+    as_of = _to_timestamp(as_of)
+    result = {}
+    with open(os.path.abspath(store_path), "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for key in keys:
+                result[key] = None
+                if key not in index["series"]:
+                    continue
+                entry = index["series"][key]
+                i = bisect.bisect_right(entry[0], as_of) - 1
+                if i >= 0:
+                    result[key] = _reconstruct(mm, entry, i, \
+                        json.loads(key)[3])
+        finally:
+            mm.close()
+
+    return result
+
+
+def _check_period_range(periods):
+
+    # Returns the granularity of a list of periods, after checking that they
+    # are consecutive (which is what the record format assumes).
+    granularity = period_granularity(periods)
+    if len(periods) == 0 or [parse_period(period) for period in periods] != \
+        [parse_period(period) for period in period_range(periods[0], \
+        periods[-1], granularity)]:
+        raise Exception("Snapshots require a consecutive range of periods")
+
+    return granularity
+
+
+def append_snapshot(store_path, result_dict, timestamp=None, database=None, \
+    pubmed_field=None, exact_phrase=None):
+
+    """Appends the counts in a result_dict to a snapshot store, creating the
+    store if it doesn't exist yet. Existing data is never overwritten, so
+    repeatedly storing the same terms builds up a history of how their counts
+    changed (e.g. due to back-indexing on PubMed). Unchanged counts take up
+    about one byte per period. Yearly, quarterly, and monthly counts are
+    stored as separate histories.
+
+    Arguments
+
+    store_path      -   str. Path to the snapshot store.
+
+    result_dict     -   dict. Results, as returned by compute_yearly_citations
+                        or load_results_from_file.
+
+    Keyword arguments
+
+    timestamp       -   float, datetime.date, or datetime.datetime. The time
+                        at which the counts were fetched, or None to use the
+                        current time. Snapshots of a term have to be appended
+                        in chronological order. Default = None
+
+    database, pubmed_field, exact_phrase
+                    -   How the counts were fetched (see get_yearly_count).
+                        Each term's history is stored separately for each
+                        combination of these. None means the setting that
+                        compute_yearly_citations recorded in the result_dict
+                        (under "_query"), or else the default of
+                        compute_yearly_citations. Default = None
+    """
+
+    timestamp = _to_timestamp(timestamp)
+    year_range = list(result_dict["_year_range"])
+    granularity = _check_period_range(year_range)
+    database, pubmed_field, exact_phrase = _query_settings(result_dict, \
+        database, pubmed_field, exact_phrase)
+    # Terms can be both a target and a comparison, but should only be stored
+    # once.
+    terms = []
+    for term in result_dict["_target"] + result_dict["_comparison"]:
+        if term not in terms:
+            terms.append(term)
+    keys = [_series_key(term, database, pubmed_field, exact_phrase, \
+        granularity) for term in terms]
+
+    # Create the store if necessary.
+    if not os.path.isfile(store_path):
+        with open(store_path, "wb") as f:
+            f.write(_magic)
+
+    # Find the previous snapshot of each term, to encode the new counts
+    # relative to it.
+    index = _read_store_index(store_path)
+    previous = _snapshot_at(store_path, keys, float("inf"))
+
+    records = bytearray()
+    for term, key in zip(terms, keys):
+        counts = [int(c) for c in result_dict[term]]
+        # Decide whether to write a keyframe or a delta record.
+        kind = _keyframe
+        if key in index["series"].keys():
+            entry = index["series"][key]
+            if timestamp < entry[0][-1]:
+                raise Exception("Cannot append a snapshot of '{}' ".format( \
+                    term) + "that is older than its latest snapshot")
+            n_since_keyframe = entry[2][::-1].index(_keyframe)
+            if previous[key][0] == year_range and \
+                n_since_keyframe < _keyframe_interval - 1:
+                kind = _delta
+        if kind == _keyframe:
+            values = delta_encode(counts)
+        else:
+            values = [c - p for c, p in zip(counts, previous[key][1])]
+        # Construct the record.
+        key_bytes = key.encode("utf-8")
+        payload = _timestamp_struct.pack(timestamp) \
+            + encode_varints([len(key_bytes)]) + key_bytes + bytes([kind]) \
+            + encode_varints([zigzag_encode(_period_ordinal(year_range[0])), \
+            len(counts)]) \
+            + encode_varints([zigzag_encode(v) for v in values])
+        records += _length_struct.pack(len(payload)) + payload
+
+    # Write all records in one go.
+    with open(store_path, "ab") as f:
+        f.write(records)
+
+
+def list_snapshots(store_path, term, database=None, pubmed_field=None, \
+    exact_phrase=None, granularity="year"):
+
+    """Returns a list of the timestamps (float, in seconds since the Unix
+    epoch) of all snapshots of a term, in chronological order. See
+    load_snapshot for the keyword arguments.
+    """
+
+    key = _series_key(term, *(_query_settings(None, database, pubmed_field, \
+        exact_phrase) + (granularity,)))
+    index = _read_store_index(store_path)
+    if key not in index["series"].keys():
+        return []
+
+    return list(index["series"][key][0])
+
+
+def load_snapshot(store_path, search_term, comparison_terms=None, \
+    as_of=None, database=None, pubmed_field=None, exact_phrase=None, \
+    granularity="year"):
+
+    """Loads the counts of terms as they were known at a specific time.
+
+    Arguments
+
+    store_path      -   str. Path to the snapshot store.
+
+    search_term     -   str or list. The target term(s).
+
+    Keyword arguments
+
+    comparison_terms-   str or list. The comparison term(s). Default = None
+
+    as_of           -   float, datetime.date, or datetime.datetime. The
+                        latest snapshot of each term at or before this time
+                        is returned, or the latest snapshot overall if as_of
+                        is None. Note that a date means the start (midnight)
+                        of that day. Default = None
+
+    database, pubmed_field, exact_phrase
+                    -   Which series to load (see append_snapshot). None
+                        means the default of compute_yearly_citations.
+                        Default = None
+
+    granularity     -   str. "year", "quarter", or "month". Default = "year"
+
+    Returns
+
+    result_dict     -   dict. In the same format as returned by
+                        compute_yearly_citations. All terms need to have the
+                        same range of periods.
+    """
+
+    # Wrap the search and comparison terms in a list.
+    if type(search_term) not in [tuple, list]:
+        search_term = [search_term]
+    if comparison_terms is None:
+        comparison_terms = []
+    elif type(comparison_terms) not in [tuple, list]:
+        comparison_terms = [comparison_terms]
+    search_term = list(search_term)
+    comparison_terms = list(comparison_terms)
+
+    if as_of is None:
+        as_of = float("inf")
+    database, pubmed_field, exact_phrase = _query_settings(None, database, \
+        pubmed_field, exact_phrase)
+    keys = {}
+    for term in search_term + comparison_terms:
+        keys[term] = _series_key(term, database, pubmed_field, \
+            exact_phrase, granularity)
+    snapshots = _snapshot_at(store_path, list(keys.values()), as_of)
+
+    result_dict = {"_target":search_term, "_comparison":comparison_terms, \
+        "_year_range":None, "_query":{"database":database, \
+        "pubmed_field":pubmed_field, "exact_phrase":exact_phrase}}
+    for term in search_term + comparison_terms:
+        if snapshots[keys[term]] is None:
+            raise Exception("No snapshot of '{}' at the requested time" \
+                .format(term))
+        year_range, counts = snapshots[keys[term]]
+        if result_dict["_year_range"] is None:
+            result_dict["_year_range"] = year_range
+        elif result_dict["_year_range"] != year_range:
+            raise Exception("Snapshots of '{}' cover a different ".format( \
+                term) + "range of periods than those of other terms")
+        result_dict[term] = counts
+
+    return result_dict
+
+
+def changes_since(store_path, since, as_of=None, terms=None, \
+    database=None, pubmed_field=None, exact_phrase=None, granularity="year"):
+
+    """Finds which counts changed between two points in time.
+
+    Arguments
+
+    store_path      -   str. Path to the snapshot store.
+
+    since           -   float, datetime.date, or datetime.datetime. The
+                        earlier point in time.
+
+    Keyword arguments
+
+    as_of           -   float, datetime.date, or datetime.datetime. The later
+                        point in time, or None for the latest snapshots.
+                        Default = None
+
+    terms           -   list. Terms to check, or None to check all terms in
+                        the store. Default = None
+
+    database, pubmed_field, exact_phrase, granularity
+                    -   Which series to check (see load_snapshot).
+
+    Returns
+
+    changes         -   dict. Maps each term with changes onto a list of
+                        (period, old_count, new_count) tuples. old_count is
+                        None for periods (or terms) that had no snapshot yet
+                        at the earlier time.
+    """
+
+    settings = list(_query_settings(None, database, pubmed_field, \
+        exact_phrase)) + [granularity]
+    if terms is None:
+        terms = []
+        for key in _read_store_index(store_path)["series"].keys():
+            if json.loads(key)[:4] == settings:
+                terms.append(json.loads(key)[4])
+    keys = dict([(term, _series_key(term, *settings)) for term in terms])
+    if as_of is None:
+        as_of = float("inf")
+    before = _snapshot_at(store_path, list(keys.values()), since)
+    after = _snapshot_at(store_path, list(keys.values()), as_of)
+
+    changes = {}
+    for term in terms:
+        key = keys[term]
+        if after[key] is None:
+            continue
+        old = {}
+        if before[key] is not None:
+            old = dict(zip(before[key][0], before[key][1]))
+        changed = []
+        for year, count in zip(after[key][0], after[key][1]):
+            if old.get(year, None) != count:
+                changed.append((year, old.get(year, None), count))
+        if len(changed) > 0:
+            changes[term] = changed
+
+    return changes
@@ -0,0 +1,21 @@
+# Part of bibliobanana, by Edwin Dalmaijer
+# https://github.com/esdalmaijer/bibliobanana
+
+# Command to run a worker for a Coordinator (see
+# bibliobanana.distributed.run_worker), e.g. with:
+# python -m bibliobanana.worker URL [API_KEY]
+# This lives in its own module, rather than in bibliobanana.distributed,
+# because the package imports bibliobanana.distributed: running that as a
+# script would import it twice.
+
+import sys
+
+from .distributed import run_worker
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python -m bibliobanana.worker URL [API_KEY]")
+        sys.exit(1)
+    run_worker(sys.argv[1], api_key=(sys.argv[2] if len(sys.argv) > 2 \
+        else None), verbose=True)
@@ -0,0 +1,96 @@
+import gzip
+import multiprocessing
+import os
+import random
+
+import pytest
+
+import bibliobanana.get
+from bibliobanana.distributed import Coordinator, run_worker
+from bibliobanana.get import TOTAL, get_yearly_count
+from bibliobanana.phrase import build_phrase_index
+
+_words = ["banana", "split", "prefrontal", "cortex", "the", "of", "rat"]
+
+
+@pytest.fixture(scope="module")
+def index_dir(tmp_path_factory):
+    # Build a small phrase index from two random PubMed files.
+    rng = random.Random(7)
+    directory = tmp_path_factory.mktemp("distributed")
+    file_paths = []
+    pmid = 1
+    for i in range(2):
+        records = []
+        for j in range(100):
+            records.append("<PubmedArticle><MedlineCitation><PMID>{}</PMID>" \
+                "<Article><Journal><JournalIssue><PubDate><Year>{}</Year>" \
+                "</PubDate></JournalIssue></Journal><ArticleTitle>{}" \
+                "</ArticleTitle></Article></MedlineCitation>" \
+                "</PubmedArticle>".format(pmid, rng.randint(1995, 2004), \
+                " ".join(rng.choice(_words) for k in range(8))))
+            pmid += 1
+        file_paths.append(os.path.join(str(directory), \
+            "pubmed00n{:04d}.xml.gz".format(i+1)))
+        with gzip.open(file_paths[-1], "wt", encoding="utf-8") as f:
+            f.write("<PubmedArticleSet>" + "".join(records) \
+                + "</PubmedArticleSet>")
+    index_dir = os.path.join(str(directory), "index")
+    build_phrase_index(file_paths, index_dir, n_processes=1)
+
+    return index_dir
+
+
+def _worker(url, index_dir):
+    run_worker(url, local_index=index_dir, poll_interval=0.1, \
+        connect_timeout=5.0)
+
+
+def _dying_worker(url, index_dir):
+    # Exits (without reporting an error) halfway through its first lease.
+    count_phrase = bibliobanana.get.count_phrase
+    calls = []
+    def count_phrase_then_die(*args, **kwargs):
+        calls.append(args)
+        if len(calls) > 2:
+            os._exit(1)
+        return count_phrase(*args, **kwargs)
+    bibliobanana.get.count_phrase = count_phrase_then_die
+    _worker(url, index_dir)
+
+
+def test_workers_on_one_machine(index_dir):
+    terms = ["banana split", "prefrontal cortex", "rat"]
+    coordinator = Coordinator(terms, 1995, 2004, comparison_terms=TOTAL, \
+        lease_size=4, lease_timeout=1.0, port=0, database="local")
+    coordinator.start()
+    # Workers are spawned rather than forked, so that, like workers on other
+    # machines, they don't share anything with the coordinator (in
+    # particular its listening socket, which would keep them waiting for
+    # replies after the coordinator stopped).
+    context = multiprocessing.get_context("spawn")
+    try:
+        # The first worker dies while it holds a lease, which then has to
+        # expire and go to one of the other workers.
+        dying = context.Process(target=_dying_worker, \
+            args=(coordinator.url, index_dir))
+        dying.start()
+        dying.join(30.0)
+        assert dying.exitcode == 1
+        assert coordinator.status()["active"] == 1
+        workers = [context.Process(target=_worker, \
+            args=(coordinator.url, index_dir)) for i in range(3)]
+        for worker in workers:
+            worker.start()
+        assert coordinator.wait(timeout=60.0)
+        result = coordinator.result()
+    finally:
+        coordinator.stop()
+    for worker in workers:
+        worker.join(30.0)
+        assert worker.exitcode == 0
+
+    assert coordinator.status()["failure"] is None
+    for term in terms + [TOTAL]:
+        assert result[term] == get_yearly_count(term, 1995, 2004, \
+            database="local", local_index=index_dir, pause=0.0)
@@ -0,0 +1,77 @@
+import gzip
+import os
+
+import pytest
+
+import bibliobanana.local
+from bibliobanana.local import ingest_pubmed_files, load_local_index
+
+
+def _article(pmid, year, title):
+    return "<PubmedArticle><MedlineCitation><PMID>{}</PMID><Article>" \
+        "<Journal><JournalIssue><PubDate><Year>{}</Year></PubDate>" \
+        "</JournalIssue></Journal><ArticleTitle>{}</ArticleTitle></Article>" \
+        "</MedlineCitation></PubmedArticle>".format(pmid, year, title)
+
+
+@pytest.fixture
+def file_paths(tmp_path):
+    # Three baseline files, and an update file that revises article 1 (from
+    # 1999 to 2001) and deletes article 2.
+    file_paths = []
+    pmid = 1
+    for i in range(3):
+        records = []
+        for j in range(30):
+            records.append(_article(pmid, 1999 + (pmid-1) % 3, \
+                "banana split"))
+            pmid += 1
+        file_paths.append(str(tmp_path / "pubmed00n{:04d}.xml.gz".format( \
+            i+1)))
+        with gzip.open(file_paths[-1], "wt", encoding="utf-8") as f:
+            f.write("<PubmedArticleSet>" + "".join(records) \
+                + "</PubmedArticleSet>")
+    file_paths.append(str(tmp_path / "pubmed00n0004.xml.gz"))
+    with gzip.open(file_paths[-1], "wt", encoding="utf-8") as f:
+        f.write("<PubmedArticleSet>" + _article(1, 2001, "banana") \
+            + "<DeleteCitation><PMID>2</PMID></DeleteCitation>" \
+            + "</PubmedArticleSet>")
+
+    return file_paths
+
+
+def test_update_file_replaces_articles(file_paths, tmp_path):
+    index_path = str(tmp_path / "index.json.gz")
+    stats = ingest_pubmed_files(file_paths, index_path, n_processes=2)
+    assert stats["n_replaced"] == 2
+    index = load_local_index(index_path, use_cache=False)
+    assert index["total"] == {"1999":29, "2000":29, "2001":31}
+    assert index["text"]["split"] == {"1999":29, "2000":29, "2001":30}
+
+
+def test_resume_after_interrupted_checkpoint(file_paths, tmp_path, \
+    monkeypatch):
+    # Kill the run after the second checkpoint was committed to the record
+    # database, but before the index file was written.
+    expected_path = str(tmp_path / "expected.json.gz")
+    ingest_pubmed_files(file_paths, expected_path, n_processes=2)
+    expected = load_local_index(expected_path, use_cache=False)
+
+    write = bibliobanana.local._write_local_index
+    calls = []
+    def interrupted_write(index_path, data):
+        calls.append(index_path)
+        if len(calls) == 2:
+            raise KeyboardInterrupt()
+        write(index_path, data)
+    monkeypatch.setattr(bibliobanana.local, "_write_local_index", \
+        interrupted_write)
+    index_path = str(tmp_path / "index.json.gz")
+    with pytest.raises(KeyboardInterrupt):
+        ingest_pubmed_files(file_paths, index_path, n_processes=2, \
+            checkpoint_every=1)
+    assert len(load_local_index(index_path, use_cache=False)["_files"]) == 1
+    monkeypatch.setattr(bibliobanana.local, "_write_local_index", write)
+
+    ingest_pubmed_files(file_paths, index_path, n_processes=2)
+    assert load_local_index(index_path, use_cache=False) == expected
@@ -0,0 +1,130 @@
+import gzip
+import os
+import random
+
+import pytest
+
+from bibliobanana.phrase import build_phrase_index, count_articles, \
+    count_phrase, count_phrase_brute_force, load_phrase_index
+
+# Small vocabulary, so that phrases (and repeated tokens) occur often.
+_words = ["banana", "split", "prefrontal", "cortex", "fart", "the", "of", \
+    "rat", "brain"]
+
+_phrases = ["banana", "banana split", "prefrontal cortex", "banana banana", \
+    "the the the", "cortex of the rat", "split banana", "rat brain banana", \
+    "unknownword", "banana unknownword"]
+
+
+def _write_file(file_path, records):
+    with gzip.open(file_path, "wt", encoding="utf-8") as f:
+        f.write("<PubmedArticleSet>" + "".join(records) \
+            + "</PubmedArticleSet>")
+
+
+def _delete(pmids):
+    return "<DeleteCitation>" + "".join("<PMID>{}</PMID>".format(pmid) \
+        for pmid in pmids) + "</DeleteCitation>"
+
+
+def _article(rng, pmid, year, title=None, abstract=None):
+    if title is None:
+            title = " ".join(rng.choice(_words) for i in \
+            range(rng.randint(1, 6)))
+    if abstract is None:
+        abstract = " ".join(rng.choice(_words) for i in \
+            range(rng.randint(0, 30)))
+    if year is None:
+        date = "<MedlineDate>Spring</MedlineDate>"
+    else:
+        date = "<Year>{}</Year>".format(year)
+    # Nested markup should be tokenised like plain text.
+    return "<PubmedArticle><MedlineCitation><PMID>{}</PMID><Article>" \
+        "<Journal><JournalIssue><PubDate>{}</PubDate></JournalIssue>" \
+        "</Journal><ArticleTitle>{}</ArticleTitle><Abstract><AbstractText>" \
+        "<i>{}</i></AbstractText></Abstract></Article></MedlineCitation>" \
+        "</PubmedArticle>".format(pmid, date, title, abstract)
+
+
+@pytest.fixture(scope="module")
+def corpus(tmp_path_factory):
+    # Write a few gzipped PubMed files with random articles, and an update
+    # file that revises and deletes some of them.
+    rng = random.Random(42)
+    directory = tmp_path_factory.mktemp("corpus")
+    file_paths = []
+    pmid = 1
+    for i in range(3):
+        records = []
+        for j in range(200):
+            year = rng.choice([1999, 2000, 2001, 2002, None])
+            records.append(_article(rng, pmid, year))
+            pmid += 1
+        file_paths.append(os.path.join(str(directory), \
+            "pubmed00n{:04d}.xml.gz".format(i+1)))
+        _write_file(file_paths[-1], records + [_delete([1])])
+    # Revisions (some of them twice within the file, or without a year),
+    # deletions, and an article that is deleted and then added again.
+    records = []
+    for revised in rng.sample(range(2, pmid), 60):
+        records.append(_article(rng, revised, rng.choice([1999, 2003, \
+            None])))
+    records.append(_article(rng, 5, 2003))
+    records.append(_delete(rng.sample(range(2, pmid), 40) + [7]))
+    records.append(_article(rng, 7, 2000))
+    file_paths.append(os.path.join(str(directory), "pubmed00n0004.xml.gz"))
+    _write_file(file_paths[-1], records)
+    index_dir = os.path.join(str(directory), "index")
+    build_phrase_index(file_paths, index_dir, n_processes=2)
+
+    return file_paths, index_dir
+
+
+@pytest.mark.parametrize("exact_phrase", [True, False])
+@pytest.mark.parametrize("phrase", _phrases)
+def test_count_phrase_matches_brute_force(corpus, phrase, exact_phrase):
+    file_paths, index_dir = corpus
+    assert count_phrase(index_dir, phrase, exact_phrase=exact_phrase, \
+        use_cache=False) == count_phrase_brute_force(file_paths, phrase, \
+        exact_phrase=exact_phrase)
+
+
+def test_count_articles(corpus):
+    # An empty phrase matches every article that has a year.
+    file_paths, index_dir = corpus
+    assert count_articles(index_dir) == \
+        count_phrase_brute_force(file_paths, "")
+
+
+def test_index_is_reopened_after_adding_files(corpus, tmp_path):
+    file_paths, index_dir = corpus
+    new_dir = str(tmp_path / "index")
+    build_phrase_index(file_paths[:2], new_dir, n_processes=1)
+    assert len(load_phrase_index(new_dir)["segments"]) == 2
+    assert count_phrase(new_dir, "banana split") == \
+        count_phrase_brute_force(file_paths[:2], "banana split")
+    build_phrase_index(file_paths, new_dir, n_processes=1)
+    assert len(load_phrase_index(new_dir)["segments"]) == 4
+    assert count_phrase(new_dir, "banana split") == \
+        count_phrase_brute_force(file_paths, "banana split")
+    assert count_articles(new_dir) == count_phrase_brute_force(file_paths, "")
+
+
+def test_update_file_replaces_articles(tmp_path):
+    # Article 1 moves from 1999 to 2001, and article 2 is deleted.
+    rng = random.Random(0)
+    baseline = str(tmp_path / "pubmed00n0001.xml.gz")
+    update = str(tmp_path / "pubmed00n0002.xml.gz")
+    _write_file(baseline, [_article(rng, 1, 1999, "banana split", ""), \
+        _article(rng, 2, 2000, "banana split", ""), \
+        _article(rng, 3, 2000, "banana split", "")])
+    _write_file(update, [_article(rng, 1, 2001, "banana split", ""), \
+        _delete([2])])
+    index_dir = str(tmp_path / "index")
+    stats = build_phrase_index([baseline, update], index_dir, n_processes=2)
+    assert stats["n_replaced"] == 2
+    expected = {"2000":1, "2001":1}
+    assert count_phrase(index_dir, "banana split") == expected
+    assert count_articles(index_dir) == expected
+    assert count_phrase_brute_force([baseline, update], "banana split") == \
+        expected